@@ -4,85 +4,212 @@ import ray
 import sys
 
 from .common import Logger
+from .distributed import NUM_WORKERS
+from .distributed import get_free_port
+from .distributed import get_shards
+from .distributed import train_worker
 from .load_data import init_setup
+from .scheduler import BYTES_PER_ROW
+from .scheduler import get_num_cpus
+from .scheduler import get_task_config
+from .scheduler import plan_tasks
+from .scheduler import plan_workers
 from .train import run_training
 from .train import run_training_all
 from .train import run_training_specific_file
 from .test import get_all_data
 from .test import run_testing
+from .test import run_testing_matrix
 from .test import run_testing_specific_file
+from .tools.split_by_instances import get_instance_files
 
 
 regions = ['AGSO', 'JAMSTEC', 'JAMSTEC2', 'NGA', 'NGA2', 'NGDC', 'NOAA_geodas', 'SIO', 'US_multi']
-param1 = ["tsv", "pickle"]
-param2 = ["train", "train-all", "test-self", "test-cross", "test-all",
+param1 = ["tsv", "pickle", "auto"]
+param2 = ["train", "train-all", "train-all-distributed", "test-self", "test-cross", "test-all",
           "train-instances", "test-instances"]
 usage_msg = "Usage: ./lgb.py <{}> <{}> <config_path>".format("|".join(param1), "|".join(param2))
 
 
 @ray.remote
-def run_training_one_region(region):
+def run_training_one_region(region, num_threads=None):
     logger = Logger()
     logfile = os.path.join(config["base_dir"], "training_log_{}.log".format(region))
     logger.set_file_handle(logfile)
-    run_training(config, [region], is_read_text, logger)
+    run_training(get_task_config(config, num_threads), [region], read_mode, logger)
 
 
-def run_training_all_regions(regions):
+def run_training_all_regions(regions, num_threads=None):
     logger = Logger()
     logfile = os.path.join(config["base_dir"], "training_log_all.log")
     logger.set_file_handle(logfile)
-    run_training_all(config, regions, is_read_text, logger)
+    run_training_all(get_task_config(config, num_threads), regions, read_mode, logger)
 
 
 @ray.remote
-def run_test(model_name, test_regions, task, data=None):
+class TrainingWorker:
+    """A worker of the distributed training, it listens on the same port in both calls."""
+    def get_address(self):
+        self.port = get_free_port()
+        return "{}:{}".format(ray.util.get_node_ip_address(), self.port)
+
+    def train(self, region_str, train_files, valid_files, rank, machines, num_threads=None):
+        logger = Logger()
+        logfile = os.path.join(
+            config["base_dir"], "training_log_{}_worker{}.log".format(region_str, rank))
+        logger.set_file_handle(logfile)
+        train_worker(get_task_config(config, num_threads), region_str, train_files, valid_files,
+                     rank, machines, self.port, logger)
+
+
+def run_training_all_distributed(regions):
+    """Train the model of all regions with Ray workers, each on a shard of the training files.
+
+    The driver writes the caches of all files first, then starts one worker
+    per shard (`distributed_workers`, spread over the nodes), collects their
+    addresses, and the workers train together with LightGBM.
+    """
+    logger = Logger()
+    logfile = os.path.join(config["base_dir"], "training_log_all.log")
+    logger.set_file_handle(logfile)
+    train_shards, shard_rows, valid_files, valid_rows = get_shards(
+        config, regions, read_mode, config.get("distributed_workers", NUM_WORKERS), logger)
+    if not train_shards:
+        logger.log("Failed to train, {}, {}".format("all", "no training data"))
+        return []
+    # The workers share the whole cluster, but none of them can be larger than a node
+    num_workers = len(train_shards)
+    workers_cpus = min(cluster_cpus, (node_cpus or cluster_cpus) * num_workers)
+    workers_memory = cluster_memory
+    if cluster_memory and memory_limit:
+        workers_memory = min(cluster_memory, memory_limit * num_workers)
+    plans = plan_workers(shard_rows, workers_cpus, workers_memory, bytes_per_row, valid_rows)
+    workers = []
+    for rank, (cpus, memory) in enumerate(plans):
+        logger.log("scheduled, {}, worker, {}, cpus, {}, memory, {}".format(
+            task, rank, cpus, memory))
+        workers.append(TrainingWorker.options(
+            num_cpus=cpus, memory=memory, scheduling_strategy="SPREAD").remote())
+    machines = ray.get([worker.get_address.remote() for worker in workers])
+    logger.log("machines, {}".format(",".join(machines)))
+    return [
+        worker.train.remote("all", shard, valid_files, rank, machines, num_threads=cpus)
+        for rank, (worker, shard, (cpus, _)) in enumerate(zip(workers, train_shards, plans))]
+
+
+@ray.remote
+def run_test(model_name, test_regions, task, data_refs=None, num_threads=None):
     logger = Logger()
     logfile = os.path.join(config["base_dir"], "testing_log_{}.log".format(model_name))
     logger.set_file_handle(logfile)
     logger.log("eval, model_region, data_region, model_size, loss, auprc, auroc, accuracy")
     task = task.split('-')[1]
-    run_testing(config, [model_name], test_regions, is_read_text, task, logger, all_data=data)
+    data = None
+    if data_refs is not None:
+        # Arrays in the object store are returned as read-only zero-copy views
+        data = dict(zip(data_refs.keys(), ray.get(list(data_refs.values()))))
+    run_testing(get_task_config(config, num_threads), [model_name], test_regions, read_mode, task,
+                logger, all_data=data)
+
+
+@ray.remote
+def run_test_matrix(model_names, test_regions, name, data_refs=None, num_threads=None):
+    logger = Logger()
+    logfile = os.path.join(config["base_dir"], "testing_log_{}.log".format(name))
+    logger.set_file_handle(logfile)
+    logger.log("eval, model_region, data_region, model_size, loss, auprc, auroc, accuracy")
+    data = None
+    if data_refs is not None:
+        data = dict(zip(data_refs.keys(), ray.get(list(data_refs.values()))))
+    run_testing_matrix(get_task_config(config, num_threads), model_names, test_regions, read_mode,
+                       name, logger, all_data=data)
 
 
 @ray.remote
-def run_training_instances(regions, region_name):
-    DATA_DIR = "data_pkl"
+def run_training_instances(region_name, num_threads=None):
+    # The model of "all" is trained on the instances of all regions
+    train_regions = regions if region_name == "all" else [region_name]
     logger = Logger()
     logfile = os.path.join(config["base_dir"], "training_inst_log_{}.log".format(region_name))
     logger.set_file_handle(logfile)
-    dirname = os.path.join(config["base_dir"], DATA_DIR)
     filenames = [
-        os.path.join(dirname, "training-instances_{}.pkl".format(region)) for region in regions]
-    run_training_specific_file(filenames, region_name, config, logger)
+        filename for region in train_regions
+        for filename in get_instance_files(config["base_dir"], region, "training")]
+    run_training_specific_file(filenames, region_name, get_task_config(config, num_threads), logger)
 
 
 @ray.remote
-def run_testing_instances(model_name, regions):
-    DATA_DIR = "data_pkl"
+def run_testing_instances(model_name, regions, num_threads=None):
     logger = Logger()
     logfile = os.path.join(config["base_dir"], "testing_inst_log_{}.log".format(model_name))
     logger.set_file_handle(logfile)
-    dirname = os.path.join(config["base_dir"], DATA_DIR)
-    filenames = [
-        os.path.join(dirname, "testing-instances_{}.pkl".format(region)) for region in regions]
-    for test_region_name, filename in zip(regions, filenames):
-        run_testing_specific_file(model_name, [filename], test_region_name, config, logger)
-    run_testing_specific_file(model_name, filenames, "all", config, logger)
+    region_filenames = [
+        get_instance_files(config["base_dir"], region, "testing") for region in regions]
+    task_config = get_task_config(config, num_threads)
+    for test_region_name, filenames in zip(regions, region_filenames):
+        run_testing_specific_file(model_name, filenames, test_region_name, task_config, logger)
+    run_testing_specific_file(
+        model_name, [filename for filenames in region_filenames for filename in filenames], "all",
+        task_config, logger)
 
 
-def get_data():
+@ray.remote
+def load_test_data(region):
     logger = Logger()
-    logfile = os.path.join(config["base_dir"], "all-data-loading.log")
+    logfile = os.path.join(config["base_dir"], "test_data_log_{}.log".format(region))
     logger.set_file_handle(logfile)
-    logger.log("start loading all datasets")
+    logger.log("start loading the test data of {}".format(region))
     with open(config["testing_files"]) as f:
         all_testing_files = f.readlines()
-    data = get_all_data(config["base_dir"], all_testing_files, regions, is_read_text, logger)
-    logger.log("finished loading all testing data")
+    data = get_all_data(config, all_testing_files, [region], read_mode, logger)
+    logger.log("finished loading the test data of {}, size, {}, bytes, {}".format(
+        region, data[0].shape, sum(array.nbytes for array in data)))
     return data
 
 
+def share_test_data(test_regions):
+    """Load the test data of each region once, and keep it in the Ray object store."""
+    logger = Logger()
+    logfile = os.path.join(config["base_dir"], "test_data_log.log")
+    logger.set_file_handle(logfile)
+    data_refs = {}
+    for region, _, memory in plan_tasks(test_regions, num_cpus, memory_limit, bytes_per_row):
+        data_refs[region] = load_test_data.options(memory=memory).remote(region)
+    total_bytes = 0
+    for region, data in zip(data_refs.keys(), ray.get(list(data_refs.values()))):
+        num_bytes = sum(array.nbytes for array in data)
+        total_bytes += num_bytes
+        logger.log("shared test data, {}, size, {}, bytes, {}".format(
+            region, data[0].shape, num_bytes))
+    logger.log("loaded the test data of {} regions once, total bytes, {}".format(
+        len(data_refs), total_bytes))
+    return data_refs
+
+
+def get_node_resources():
+    """Return the CPUs and the memory of the largest node of the Ray cluster."""
+    resources = [node["Resources"] for node in ray.nodes() if node.get("Alive")]
+    return (int(max([res.get("CPU", 0) for res in resources], default=0)),
+            int(max([res.get("memory", 0) for res in resources], default=0)))
+
+
+def schedule(remote_function, regions, *args):
+    """Submit `remote_function(region, *args)` for each region, largest regions first.
+
+    Each task reserves the CPUs and the memory planned for its region, and runs
+    LightGBM with as many threads as CPUs.
+    """
+    logger = Logger()
+    logger.set_file_handle(os.path.join(config["base_dir"], "scheduler_log.log"))
+    result_ids = []
+    for region, cpus, memory in plan_tasks(regions, num_cpus, memory_limit, bytes_per_row):
+        logger.log("scheduled, {}, {}, cpus, {}, memory, {}".format(
+            task, region, cpus, memory))
+        result_ids.append(remote_function.options(num_cpus=cpus, memory=memory).remote(
+            region, *args, num_threads=cpus))
+    return result_ids
+
+
 if __name__ == '__main__':
     if len(sys.argv) != 4:
         print(usage_msg)
@@ -94,33 +221,51 @@ if __name__ == '__main__':
     with open(sys.argv[3]) as f:
         config = json.load(f)
     config["base_dir"] = os.path.expanduser(config["base_dir"])
-    is_read_text = (sys.argv[1].lower() == "tsv")
+    read_mode = sys.argv[1].lower()
     init_setup(config["base_dir"])
     task = sys.argv[2].lower()
 
-    ray.init(num_cpus=10)
+    # Follow the cores of the machine (or `max_cpus`), and the memory Ray sees on it
+    num_cpus = get_num_cpus(config)
+    if config.get("ray_address"):
+        # Join a running Ray cluster
+        ray.init(address=config["ray_address"])
+    else:
+        ray.init(num_cpus=num_cpus)
+    # A task runs on one node, so the tasks are sized by the largest node. Only the workers
+    # of the distributed training are sized by the whole cluster.
+    node_cpus, node_memory = get_node_resources()
+    num_cpus = min(num_cpus, node_cpus or num_cpus)
+    memory_limit = node_memory or None
+    cluster_cpus = int(ray.cluster_resources().get("CPU", num_cpus))
+    cluster_memory = ray.cluster_resources().get("memory")
+    bytes_per_row = config.get("bytes_per_row", BYTES_PER_ROW)
     result_ids = []
     if task == "train":
-        for region in regions:
-            result_ids.append(run_training_one_region.remote(region))
+        result_ids = schedule(run_training_one_region, regions)
     elif task == "train-all":
-        run_training_all_regions(regions)
+        run_training_all_regions(regions, num_cpus)
+    elif task == "train-all-distributed":
+        result_ids = run_training_all_distributed(regions)
     elif task == "test-cross":
-        for region in regions:
-            result_ids.append(run_test.remote(region, regions, task))
+        data_refs = share_test_data(regions)
+        result_ids.append(run_test_matrix.options(num_cpus=num_cpus).remote(
+            regions, regions, "cross", data_refs, num_threads=num_cpus))
     elif task == "test-all":
-        result_ids.append(run_test.remote("all", regions, "test-cross"))
+        data_refs = share_test_data(regions)
+        result_ids.append(run_test_matrix.options(num_cpus=num_cpus).remote(
+            ["all"], regions, "all", data_refs, num_threads=num_cpus))
     elif task == "train-instances":
-        for region in regions:
-            result_ids.append(run_training_instances.remote([region], region))
-        result_ids.append(run_training_instances.remote(regions, "all"))
+        result_ids = schedule(run_training_instances, regions + ["all"])
     elif task == "test-instances":
-        for region in regions:
-            result_ids.append(run_testing_instances.remote(region, regions))
-        result_ids.append(run_testing_instances.remote("all", regions))
+        result_ids = schedule(run_testing_instances, regions + ["all"], regions)
     elif task == "test-self":
-        for region in regions:
-            result_ids.append(run_test.remote(region, [region], task))
+        data_refs = share_test_data(regions)
+        result_ids = [
+            run_test.options(num_cpus=cpus, memory=memory).remote(
+                region, [region], task, {region: data_refs[region]}, num_threads=cpus)
+            for region, cpus, memory in plan_tasks(
+                regions, num_cpus, memory_limit, bytes_per_row)]
     else:
         assert(False)
     results = ray.get(result_ids)
@@ -1,56 +1,206 @@
+import hashlib
+import json
 import lightgbm as lgb
 import pickle
 import numpy as np
-from sklearn.metrics import auc
-from sklearn.metrics import precision_recall_curve
-from sklearn.metrics import roc_curve
+import os
+from time import time
 from .common import print_ts
+from .common import record_telemetry
+from .common import save_checkpoint
+from .load_data import get_checkpoint_path
+from .load_data import get_feature_columns
+from .load_data import get_text_model_path
 from .load_data import persist_model
+from .metrics import METRIC_NAMES
+from .metrics import ScoreHistogram
+from .metrics import ranking_metrics
+from .tree_engine import TreeEnsemble
 
-def train(config, train_dataset, valid_dataset, region, logger):
+
+PREDICT_BATCH_SIZE = 1000000
+# Keys of the config that are not LightGBM parameters
+NON_LGB_PARAMS = [
+    "base_dir", "training_files", "validation_files", "testing_files", "load_workers",
+    "max_inflight_files", "rounds", "early_stopping_rounds", "checkpoint_rounds", "max_cpus",
+    "bytes_per_row", "eval_workers", "predict_batch_size", "approximate_metrics",
+    "inference_engine", "feature_set", "feature_sets", "distributed_workers",
+    "distributed_tree_learner", "ray_address",
+]
+# LightGBM parameters that do not change the model, or that change between the runs of
+# distributed training, left out of the checkpoint key
+CHECKPOINT_IGNORED_PARAMS = [
+    "num_thread", "num_threads", "nthread", "n_jobs", "machines", "local_listen_port",
+    "num_machines", "pre_partition",
+]
+
+
+def get_lgb_params(config):
+    # `early_stopping_rounds` would otherwise be read by LightGBM as its own early stopping
+    return {key: value for key, value in config.items() if key not in NON_LGB_PARAMS}
+
+
+def get_checkpoint_key(config):
+    """Return the key of the training parameters and of the feature columns of `config`.
+
+    The key is saved next to the checkpoints, so that a run with other
+    parameters or features does not resume from them.
+    """
+    params = {key: value for key, value in get_lgb_params(config).items()
+              if key not in CHECKPOINT_IGNORED_PARAMS}
+    key = {"params": params, "features": get_feature_columns(config)}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def read_checkpoint_key(checkpoint_path):
+    try:
+        with open(checkpoint_path + ".key") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def remove_checkpoint(checkpoint_path):
+    for path in [checkpoint_path, checkpoint_path + ".key"]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def has_checkpoint(config, region):
+    """Check if there is a checkpoint of `region` trained with the parameters of `config`."""
+    checkpoint_path = get_checkpoint_path(config["base_dir"], region)
+    return config.get("checkpoint_rounds", 0) > 0 and os.path.exists(checkpoint_path) and \
+        read_checkpoint_key(checkpoint_path) == get_checkpoint_key(config)
+
+
+def train(config, train_dataset, valid_dataset, region, logger, persist=True):
+    """Train for `config["rounds"]` rounds, resuming from the checkpoint of `region` if any.
+
+    Resuming needs the raw features of the datasets to compute the scores of
+    the checkpoint model, so they must be built with `free_raw_data=False`.
+    Early stopping (`early_stopping_rounds`, on the validation data) keeps the
+    best iteration in the persisted model. In distributed training, only the
+    worker with `persist` writes the checkpoints and the model.
+    """
     logger.log("start training...")
-    # Strange bug exists that prevents saving all iterations if `early_stopping_rounds` is enabled
-    config["early_stopping_rounds"] = None
+    checkpoint_path = get_checkpoint_path(config["base_dir"], region)
+    checkpoint_rounds = config.get("checkpoint_rounds", 0)
+    checkpoint_key = get_checkpoint_key(config)
+    if persist and os.path.exists(checkpoint_path) and \
+            read_checkpoint_key(checkpoint_path) != checkpoint_key:
+        logger.log("removing the checkpoint of {}, trained with other parameters".format(region))
+        remove_checkpoint(checkpoint_path)
     valid_sets = [train_dataset]
     if valid_dataset is not None:
         valid_sets.append(valid_dataset)
+    callbacks = [print_ts(logger), record_telemetry(logger, region)]
+    if checkpoint_rounds > 0 and persist:
+        callbacks.append(
+            save_checkpoint(logger, checkpoint_path, checkpoint_rounds, checkpoint_key))
+    if valid_dataset is not None and config.get("early_stopping_rounds"):
+        callbacks.append(lgb.early_stopping(config["early_stopping_rounds"], verbose=False))
+    init_model = None
+    num_rounds = config["rounds"]
+    start_time = time()
     try:
-        gbm = lgb.train(
-            config,
-            train_dataset,
-            num_boost_round=config["rounds"],
-            valid_sets=valid_sets,
-            callbacks=[print_ts(logger)],
-            # early_stopping_rounds=config["early_stopping_rounds"],
-            # fobj=expobj, feval=exp_eval,
-        )
+        if has_checkpoint(config, region):
+            init_model = lgb.Booster(model_file=checkpoint_path)
+            num_rounds = max(0, config["rounds"] - init_model.current_iteration())
+            logger.log("resuming from the checkpoint at tree {}, {} rounds to go".format(
+                init_model.current_iteration(), num_rounds))
+        if init_model is not None and num_rounds == 0:
+            # The run was stopped after the last checkpoint, before persisting the model
+            gbm = init_model
+        else:
+            gbm = lgb.train(
+                get_lgb_params(config),
+                train_dataset,
+                num_boost_round=num_rounds,
+                valid_sets=valid_sets,
+                init_model=init_model,
+                callbacks=callbacks,
+                # fobj=expobj, feval=exp_eval,
+            )
     except Exception as e:
         logger.log("Failed to train, {}, {}".format(region, e))
+        logger.flush()
         return
     logger.log("training completed.")
+    logger.record("train", region=region, num_trees=gbm.num_trees(),
+                  best_iteration=gbm.best_iteration, seconds=time() - start_time)
+    logger.flush()
+    # `lgb.train` only keeps the trees up to the best iteration, which the pickle also records,
+    # so fewer trees than rounds means that the training stopped early
+    if gbm.current_iteration() < config["rounds"]:
+        logger.log("early stopped, best iteration, {}".format(gbm.best_iteration))
+    elif gbm.best_iteration > 0:
+        logger.log("best iteration, {}".format(gbm.best_iteration))
+    if not persist:
+        return
     persist_model(config["base_dir"], region, gbm)
     logger.log("Model for {} is persisted".format(region))
+    remove_checkpoint(checkpoint_path)
 
 
-def get_scores(region, test_region, features, labels, pkl_model_path, logger):
-    # load model with pickle to predict
+def load_model(pkl_model_path, engine="lightgbm"):
+    # The "numpy" engine compiles the text model, and does not need LightGBM to score
+    if engine == "numpy":
+        return TreeEnsemble.from_file(get_text_model_path(pkl_model_path))
+    assert(engine == "lightgbm")
     with open(pkl_model_path, 'rb') as fin:
-        model = pickle.load(fin)
+        return pickle.load(fin)
+
+
+def get_scores(region, test_region, features, labels, pkl_model_path, logger,
+               batch_size=PREDICT_BATCH_SIZE, num_threads=0, weights=None, approximate=False,
+               engine="lightgbm"):
+    # load model with pickle to predict
+    model = load_model(pkl_model_path, engine)
+    scores, _ = score_model(
+        model, region, test_region, features, labels, logger, num_threads, batch_size, weights,
+        approximate)
+    return scores
+
+
+def predict_in_batches(model, features, labels, weights=None, batch_size=PREDICT_BATCH_SIZE,
+                       num_threads=0):
+    """Predict `batch_size` rows at a time into a preallocated score array.
+
+    Returns the clipped scores along with a `ScoreHistogram` that accumulated
+    the loss, the accuracy and the score distribution batch by batch.
+    """
+    params = {"num_threads": num_threads} if num_threads > 0 else {}
+    num_rows = features.shape[0]
+    batch_size = max(1, batch_size)
+    scores = np.empty(num_rows)
+    histogram = ScoreHistogram()
+    for st in range(0, num_rows, batch_size):
+        ed = min(num_rows, st + batch_size)
+        batch_scores = scores[st:ed]
+        np.clip(model.predict(features[st:ed], **params), 1e-15, 1.0 - 1e-15, out=batch_scores)
+        histogram.update(labels[st:ed], batch_scores, None if weights is None else weights[st:ed])
+    return (scores, histogram)
 
+
+def score_model(model, region, test_region, features, labels, logger, num_threads=0,
+                batch_size=PREDICT_BATCH_SIZE, weights=None, approximate=False):
     # Prediction
-    preds = model.predict(features)
-    scores = np.clip(preds, 1e-15, 1.0 - 1e-15)
+    start_time = time()
+    scores, histogram = predict_in_batches(
+        model, features, labels, weights, batch_size, num_threads)
+    predict_seconds = time() - start_time
     logger.log('finished prediction')
 
-    # compute auprc
-    loss = np.mean(labels * -np.log(scores) + (1 - labels) * -np.log(1.0 - scores))
-    precision, recall, _ = precision_recall_curve(labels, scores, pos_label=1)
-    auprc = auc(recall, precision)
-    fpr, tpr, _ = roc_curve(labels, scores, pos_label=1)
-    auroc = auc(fpr, tpr)
-    # accuracy
-    acc = np.sum(labels == (scores > 0.5)) / labels.shape[0]
-
+    # AUPRC and AUROC are computed from the histogram in the approximate mode
+    ranking = None if approximate else ranking_metrics(labels, scores, weights)
+    metrics = histogram.metrics(ranking)
     logger.log("eval, {}, {}, {}, {}, {}, {}, {}".format(
-        region, test_region, model.num_trees(), loss, auprc, auroc, acc))
-    return scores
+        region, test_region, model.num_trees(),
+        metrics["loss"], metrics["auprc"], metrics["auroc"], metrics["accuracy"]))
+    logger.log("weighted eval, {}, {}, {}, {}, {}, {}, {}".format(
+        region, test_region, model.num_trees(), metrics["weighted_loss"],
+        metrics["weighted_auprc"], metrics["weighted_auroc"], metrics["weighted_accuracy"]))
+    logger.record("eval", model_region=region, test_region=test_region, rows=len(labels),
+                  num_trees=model.num_trees(), predict_seconds=predict_seconds,
+                  seconds=time() - start_time, metrics=metrics)
+    return (scores, (model.num_trees(),) + tuple(metrics[name] for name in METRIC_NAMES))
@@ -0,0 +1,213 @@
+import fcntl
+import json
+import os
+import pickle
+import numpy as np
+
+
+# Layout of a columnar cache file:
+#   [0, HEADER_SIZE)  MAGIC followed by a JSON header, padded with spaces
+#   features          `rows x len(columns)` array in column-major order, float64 unless the
+#                     header says otherwise
+#   labels            `rows` int8 labels
+#   weights           optional, `rows` float64 weights
+MAGIC = b"BATHYCOL"
+VERSION = 1
+HEADER_SIZE = 4096
+FEATURE_DTYPE = np.dtype('<f8')
+LABEL_DTYPE = np.dtype('i1')
+WEIGHT_DTYPE = np.dtype('<f8')
+ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_columnar(filename, features, labels, weights=None, columns=None, dtype=FEATURE_DTYPE):
+    features = np.asarray(features)
+    if features.ndim == 1:
+        features = features.reshape(len(labels), -1)
+    if columns is None:
+        columns = list(range(features.shape[1]))
+    write_columnar_blocks(filename, [(features, labels, weights, None)], columns, dtype)
+
+
+def write_columnar_blocks(filename, blocks, columns, dtype=FEATURE_DTYPE, positions=None):
+    """Write the rows of several blocks into one columnar cache file, one column at a time.
+
+    Each block is ``(features, labels, weights, rows)``, where ``rows`` selects
+    the rows of the block to write (a boolean mask or indices, None for all).
+    The features may be memory-mapped column-major caches, since only one
+    column of one block is read at a time. Weights are written if every block
+    has them. The features are written as `dtype`.
+
+    `positions` gives, for each block, the positions of `columns` in its
+    features, which may have other columns. By default the features of a
+    block are exactly `columns`.
+    """
+    dtype = np.dtype(dtype)
+    blocks = [(np.asarray(features), np.asarray(labels), weights, selected)
+              for features, labels, weights, selected in blocks]
+    if positions is None:
+        assert(all(block[0].shape[1] == len(columns) for block in blocks))
+        positions = [list(range(len(columns)))] * len(blocks)
+    rows = 0
+    for (features, labels, weights, selected), block_positions in zip(blocks, positions):
+        assert(features.shape[0] == labels.shape[0])
+        assert(len(block_positions) == len(columns))
+        assert(weights is None or len(weights) == labels.shape[0])
+        if selected is None:
+            rows += labels.shape[0]
+        else:
+            selected = np.asarray(selected)
+            rows += int(np.sum(selected)) if selected.dtype == bool else len(selected)
+    cols = len(columns)
+    has_weights = len(blocks) > 0 and all(block[2] is not None for block in blocks)
+
+    features_offset = HEADER_SIZE
+    labels_offset = _align(features_offset + rows * cols * dtype.itemsize)
+    weights_offset = None
+    if has_weights:
+        weights_offset = _align(labels_offset + rows * LABEL_DTYPE.itemsize)
+    header = {
+        "version": VERSION,
+        "rows": rows,
+        "columns": [int(c) for c in columns],
+        "dtype": dtype.str,
+        "label_dtype": LABEL_DTYPE.str,
+        "weight_dtype": WEIGHT_DTYPE.str,
+        "features_offset": features_offset,
+        "labels_offset": labels_offset,
+        "weights_offset": weights_offset,
+    }
+    header = MAGIC + json.dumps(header).encode()
+    assert(len(header) < HEADER_SIZE)
+
+    def select(array, selected):
+        return array if selected is None else array[selected]
+
+    # Write to a temporary file first so that readers never see a partial cache
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b' '))
+        for j in range(cols):
+            for (features, _, _, selected), block_positions in zip(blocks, positions):
+                column = select(features[:, block_positions[j]], selected)
+                np.ascontiguousarray(column, dtype=dtype).tofile(f)
+        f.write(b'\0' * (labels_offset - f.tell()))
+        for _, labels, _, selected in blocks:
+            (select(labels, selected) > 0).astype(LABEL_DTYPE).tofile(f)
+        if has_weights:
+            f.write(b'\0' * (weights_offset - f.tell()))
+            for _, _, weights, selected in blocks:
+                np.asarray(select(weights, selected), dtype=WEIGHT_DTYPE).tofile(f)
+    os.replace(tmp_filename, filename)
+
+
+def is_columnar(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_header(filename):
+    with open(filename, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if not header.startswith(MAGIC):
+        raise ValueError("{} is not a columnar cache file".format(filename))
+    header = json.loads(header[len(MAGIC):].decode().rstrip())
+    if header["version"] > VERSION:
+        raise ValueError("{} is written by a newer version ({})".format(
+            filename, header["version"]))
+    return header
+
+
+def _read_array(filename, dtype, offset, shape, order, mmap_mode):
+    count = int(np.prod(shape))
+    if count == 0:
+        return np.empty(shape, dtype=dtype, order=order)
+    if mmap_mode:
+        return np.memmap(filename, dtype=dtype, mode=mmap_mode, offset=offset, shape=shape,
+                         order=order)
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        array = np.fromfile(f, dtype=dtype, count=count)
+    return array.reshape(shape, order=order)
+
+
+def open_columnar(filename, mmap_mode='r'):
+    """Open a columnar cache file, memory-mapped unless `mmap_mode` is None.
+
+    Returns
+    -------
+    data : tuple
+        ``(features, labels, weights, header)``, ``weights`` is None if the
+        file does not store them.
+    """
+    header = read_header(filename)
+    rows = header["rows"]
+    features = _read_array(
+        filename, np.dtype(header["dtype"]), header["features_offset"],
+        (rows, len(header["columns"])), 'F', mmap_mode)
+    labels = _read_array(
+        filename, np.dtype(header["label_dtype"]), header["labels_offset"], (rows,), 'C',
+        mmap_mode)
+    weights = None
+    if header["weights_offset"] is not None:
+        weights = _read_array(
+            filename, np.dtype(header["weight_dtype"]), header["weights_offset"], (rows,), 'C',
+            mmap_mode)
+    return (features, labels, weights, header)
+
+
+def read_examples(filename, mmap_mode='r'):
+    """Read `(features, labels, weights)` from a columnar cache or a legacy pickle file."""
+    if is_columnar(filename):
+        features, labels, weights, _ = open_columnar(filename, mmap_mode)
+        if weights is None:
+            # A read-only view, the weights of every row are not allocated
+            weights = np.broadcast_to(1.0, labels.shape[0])
+        return (features, labels, weights)
+    with open(filename, 'rb') as f:
+        features, labels, weights = pickle.load(f)
+    # The pickle caches written by the older versions store a list of rows
+    features = np.asarray(features)
+    labels = np.asarray(labels)
+    weights = np.asarray(weights, dtype=WEIGHT_DTYPE)
+    if features.ndim == 1:
+        features = features.reshape(labels.shape[0], -1)
+    return (features, labels, weights)
+
+
+def load_manifest(filename=None):
+    if filename is None or not os.path.exists(filename):
+        return {"version": VERSION, "files": {}}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_manifest(filename, manifest):
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_filename, filename)
+
+
+def update_manifest(filename, entries, overwrite=True):
+    """Merge `entries` (cache name to entry) into the manifest `filename`, and return it.
+
+    The manifest is read again and written under a lock on ``filename + ".lock"``,
+    so that the processes that share a manifest keep the entries of each other.
+    Without `overwrite`, only the entries that are not in the manifest are added.
+    """
+    with open(filename + ".lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            manifest = load_manifest(filename)
+            for name, entry in entries.items():
+                if overwrite or name not in manifest["files"]:
+                    manifest["files"][name] = entry
+            save_manifest(filename, manifest)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return manifest
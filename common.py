@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import atexit
+import json
 import os
 import sys
 import pickle
+import resource
+import threading
 import lightgbm as lgb
 import numpy as np
 from time import time
@@ -13,27 +17,81 @@ DATA_BASE_DIR = "/geosat2/julaiti/tsv_all"
 TRAINING_FILES_DESC = os.path.join(DATA_BASE_DIR, "training_files_desc.txt")
 VALIDATION_FILES_DESC = os.path.join(DATA_BASE_DIR, "validation_files_desc.txt")
 TESTING_FILES_DESC = os.path.join(DATA_BASE_DIR, "testing_files_desc.txt")
+# The structured records are written when this many are buffered, or after this many seconds
+METRICS_BUFFER_SIZE = 200
+METRICS_FLUSH_SECONDS = 10.0
+
+
+def get_peak_rss():
+    """Return the peak resident set size of this process in bytes."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def _to_json(value):
+    # numpy scalars
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
 
 
 class Logger:
     def __init__(self):
         self.file_handle = None
+        self.metrics_handle = None
+        self.metrics_buffer = []
+        self.last_flush = time()
         self.starting_time = time()
+        # The matrix evaluation logs from several threads
+        self.lock = threading.Lock()
 
     def set_file_handle(self, log_file_name):
+        """Log text to `log_file_name`, and structured records to the `.jsonl` file next to it."""
         self.file_handle = open(log_file_name, 'w')
+        self.metrics_handle = open(log_file_name.rsplit('.', 1)[0] + ".jsonl", 'w')
+        atexit.register(self.flush)
+
+    def record(self, event, **fields):
+        """Buffer a structured record of `event`, written as one line of JSON.
+
+        Every record has the wall time, the seconds since the logger was created,
+        and the peak RSS of the process in bytes.
+        """
+        if self.metrics_handle is None:
+            return
+        now = time()
+        fields = dict(event=event, time=now, elapsed=now - self.starting_time,
+                      peak_rss=get_peak_rss(), **fields)
+        with self.lock:
+            self.metrics_buffer.append(json.dumps(fields, default=_to_json))
+            if len(self.metrics_buffer) >= METRICS_BUFFER_SIZE or \
+                    now - self.last_flush >= METRICS_FLUSH_SECONDS:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.metrics_buffer and not self.metrics_handle.closed:
+            self.metrics_handle.write("\n".join(self.metrics_buffer) + "\n")
+            self.metrics_handle.flush()
+        self.metrics_buffer = []
+        self.last_flush = time()
 
     def log(self, msg, show_time=False):
-        if show_time:
-            msg = "Current time: %.2f" % time()
+        with self.lock:
+            if show_time:
+                msg = "Current time: %.2f" % time()
+                print(msg)
+                self.file_handle.write(msg + '\n')
+
+            msg = "[%.5f] %s" % (time() - self.starting_time, msg)
             print(msg)
+            sys.stdout.flush()
             self.file_handle.write(msg + '\n')
-
-        msg = "[%.5f] %s" % (time() - self.starting_time, msg)
-        print(msg)
-        sys.stdout.flush()
-        self.file_handle.write(msg + '\n')
-        self.file_handle.flush()
+            self.file_handle.flush()
 
 
 def print_ts(logger, period=1):
@@ -57,6 +115,58 @@ def print_ts(logger, period=1):
     return callback
 
 
+def record_telemetry(logger, region, period=1):
+    """Create a callback that records the training progress every ``period`` iterations.
+
+    Each "iteration" record has the seconds per tree since the previous record,
+    the seconds since training started, and the last evaluation results on the
+    training and validation data (with the peak RSS added by ``logger.record``).
+    """
+    state = {"start": time(), "last": time(), "last_iteration": None}
+
+    def callback(env):
+        """internal function"""
+        if state["last_iteration"] is None:
+            # Resumed runs start from the iteration of the checkpoint
+            state["last_iteration"] = env.iteration
+        if period > 0 and (env.iteration + 1) % period == 0:
+            now = time()
+            num_trees = env.iteration + 1 - state["last_iteration"]
+            metrics = {"{}_{}".format(item[0], item[1]): item[2]
+                       for item in env.evaluation_result_list}
+            logger.record("iteration", region=region, iteration=env.iteration + 1,
+                          seconds_per_tree=(now - state["last"]) / max(1, num_trees),
+                          train_seconds=now - state["start"], metrics=metrics)
+            state["last"] = now
+            state["last_iteration"] = env.iteration + 1
+    callback.order = 15
+    return callback
+
+
+def save_checkpoint(logger, checkpoint_path, period, key=None):
+    """Create a callback that saves the model to ``checkpoint_path`` every ``period`` iterations.
+
+    The model is written to a temporary file first, so a crash while saving
+    leaves the previous checkpoint intact. ``key`` is written to
+    ``checkpoint_path + ".key"`` after the model, so that a crash in between
+    leaves a model without its key, which is not resumed from, and never
+    the model of other parameters with the key of this run.
+    """
+    def callback(env):
+        """internal function"""
+        if period > 0 and (env.iteration + 1) % period == 0:
+            tmp_path = checkpoint_path + ".tmp"
+            env.model.save_model(tmp_path, num_iteration=-1)
+            os.replace(tmp_path, checkpoint_path)
+            if key is not None:
+                with open(tmp_path, "w") as f:
+                    f.write(key)
+                os.replace(tmp_path, checkpoint_path + ".key")
+            logger.log('Checkpoint at tree %d' % (env.iteration + 1))
+    callback.order = 20
+    return callback
+
+
 # AdaBoost potential function
 """
 def expobj(preds, dtrain):
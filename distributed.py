@@ -0,0 +1,153 @@
+import socket
+import lightgbm as lgb
+
+from .booster import has_checkpoint
+from .booster import train
+from .file_weights import get_row_weights
+from .load_data import get_binary_filename
+from .load_data import get_caches
+from .load_data import get_datasets
+from .load_data import get_feature_columns
+from .load_data import get_region_files
+from .train import TRAIN_PREFIX
+from .train import VALID_PREFIX
+from .train import get_binning_params
+
+
+# Distributed training of one model by several workers, each on a shard of the
+# training files (LightGBM's data or voting parallel tree learner). The workers
+# read the caches of their files, which the driver writes beforehand, so the
+# base directory must be shared by all nodes.
+TREE_LEARNERS = ["data", "voting"]
+NUM_WORKERS = 2
+
+
+def prepare_caches(config, filepaths, read_mode, prefix, logger):
+    """Parse the text files into caches if needed, return the rows of each cached file."""
+    base_dir = config["base_dir"]
+    caches, _, _ = get_caches(
+        base_dir, filepaths, read_mode, prefix, logger, config.get("load_workers", 1),
+        config.get("max_inflight_files"), get_feature_columns(config))
+    # The caches are named after the source files in all read modes
+    cache_rows = {bin_filename: rows for _, bin_filename, rows, _ in caches}
+    file_rows = {}
+    for filename in filepaths:
+        bin_filename = get_binary_filename(base_dir, prefix, filename.strip())
+        if bin_filename in cache_rows:
+            file_rows[filename.strip()] = cache_rows[bin_filename]
+    return file_rows
+
+
+def shard_files(filepaths, file_rows, num_shards):
+    """Split the files into at most `num_shards` shards of about the same number of rows.
+
+    The largest files are assigned first, each to the shard with the fewest
+    rows, and the files keep their order within a shard. Files without rows
+    are dropped, and there are no empty shards.
+    """
+    filepaths = [filename.strip() for filename in filepaths
+                 if file_rows.get(filename.strip(), 0) > 0]
+    num_shards = max(1, min(num_shards, len(filepaths)))
+    shard_rows = [0] * num_shards
+    assignment = {}
+    for filename in sorted(filepaths, key=lambda filename: -file_rows[filename]):
+        shard = shard_rows.index(min(shard_rows))
+        assignment[filename] = shard
+        shard_rows[shard] += file_rows[filename]
+    shards = [[filename for filename in filepaths if assignment[filename] == shard]
+              for shard in range(num_shards)]
+    return [shard for shard in shards if shard]
+
+
+def get_free_port():
+    # The port may be taken again before LightGBM listens on it, which is unlikely
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("", 0))
+        return sock.getsockname()[1]
+
+
+def get_distributed_config(config, machines, local_port):
+    """Copy the config with the parameters of LightGBM's distributed learning.
+
+    `machines` lists the "ip:port" of every worker, and `local_port` is the
+    port of this worker.
+    """
+    tree_learner = config.get("distributed_tree_learner", "data")
+    if tree_learner not in TREE_LEARNERS:
+        raise ValueError("unknown distributed tree learner {}, choose from {}".format(
+            tree_learner, ", ".join(TREE_LEARNERS)))
+    config = dict(config)
+    config.update({
+        "tree_learner": tree_learner,
+        "machines": ",".join(machines),
+        "num_machines": len(machines),
+        "local_listen_port": int(local_port),
+        # Each worker has its own rows
+        "pre_partition": True,
+    })
+    return config
+
+
+def train_worker(config, region_str, train_files, valid_files, rank, machines, local_port,
+                 logger):
+    """Train the model of `region_str` with the other workers, on a shard of the training files.
+
+    All workers must call this function at the same time. The datasets are not
+    binned in advance, as the workers agree on the bin mappers when LightGBM
+    connects them. Every worker is given all the validation files, so that
+    they all stop early at the same iteration. Only the worker of rank 0
+    writes the checkpoints and the model.
+    """
+    base_dir = config["base_dir"]
+    columns = get_feature_columns(config)
+    # The checkpoints are keyed by the parameters of the distributed training
+    distributed_config = get_distributed_config(config, machines, local_port)
+    resume = has_checkpoint(distributed_config, region_str)
+    shard_name = "{}_part{}".format(region_str, rank)
+    logger.log("worker {} of {}, {}, {} training files".format(
+        rank, len(machines), machines[rank], len(train_files)))
+    features, labels, weights = get_datasets(
+        shard_name, base_dir, train_files, "pickle", TRAIN_PREFIX, logger,
+        config.get("load_workers", 1), config.get("max_inflight_files"), columns)
+    if len(features) == 0:
+        raise ValueError("no training data in the shard of worker {}".format(rank))
+    params = get_binning_params(config)
+    train_dataset = lgb.Dataset(
+        features, label=labels, weight=get_row_weights(weights), params=params,
+        free_raw_data=not resume)
+    valid_dataset = None
+    if valid_files:
+        features, labels, weights = get_datasets(
+            shard_name, base_dir, valid_files, "pickle", VALID_PREFIX, logger,
+            config.get("load_workers", 1), config.get("max_inflight_files"), columns)
+        if len(features) > 0:
+            valid_dataset = lgb.Dataset(
+                features, label=labels, weight=get_row_weights(weights), params=params,
+                reference=train_dataset, free_raw_data=not resume)
+    train(distributed_config, train_dataset, valid_dataset, region_str, logger,
+          persist=rank == 0)
+
+
+def get_shards(config, regions, read_mode, num_workers, logger):
+    """Write the caches of the training and validation files, and shard the training files.
+
+    Returns
+    -------
+    shards : tuple
+        ``(train_shards, shard_rows, valid_files, valid_rows)``, the training
+        files and their number of rows for each worker, and the validation
+        files and their number of rows.
+    """
+    with open(config["training_files"]) as f:
+        train_files = get_region_files(f.readlines(), regions)
+    with open(config["validation_files"]) as f:
+        valid_files = get_region_files(f.readlines(), regions)
+    train_rows = prepare_caches(config, train_files, read_mode, TRAIN_PREFIX, logger)
+    valid_rows = prepare_caches(config, valid_files, read_mode, VALID_PREFIX, logger)
+    train_shards = shard_files(train_files, train_rows, num_workers)
+    shard_rows = [sum(train_rows[filename] for filename in shard) for shard in train_shards]
+    for rank, (shard, rows) in enumerate(zip(train_shards, shard_rows)):
+        logger.log("shard, {}, files, {}, rows, {}".format(rank, len(shard), rows))
+    valid_files = [filename.strip() for filename in valid_files
+                   if valid_rows.get(filename.strip(), 0) > 0]
+    return (train_shards, shard_rows, valid_files, sum(valid_rows.values()))
@@ -0,0 +1,59 @@
+import numpy as np
+
+
+class FileWeights:
+    """The weights of the rows of a dataset, one weight per block of rows (e.g. per file).
+
+    The weights are expanded to one value per row only on demand, with
+    `expand`, `np.asarray` or by indexing, e.g. a slice of rows only expands
+    the weights of these rows.
+    """
+    def __init__(self, values=(), counts=()):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+
+    @classmethod
+    def from_rows(cls, weights):
+        """Run-length encode the weights of every row."""
+        weights = np.asarray(weights, dtype=np.float64)
+        if len(weights) == 0:
+            return cls()
+        starts = np.concatenate([[0], np.flatnonzero(weights[1:] != weights[:-1]) + 1])
+        return cls(weights[starts], np.diff(np.append(starts, len(weights))))
+
+    @classmethod
+    def concatenate(cls, weights):
+        return cls(np.concatenate([[]] + [t.values for t in weights]),
+                   np.concatenate([[]] + [t.counts for t in weights]))
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.counts.nbytes + self.offsets.nbytes
+
+    def expand(self, dtype=np.float64, start=0, stop=None):
+        """Return the weights of the rows in ``[start, stop)``."""
+        stop = len(self) if stop is None else stop
+        counts = np.minimum(self.offsets[1:], stop) - np.maximum(self.offsets[:-1], start)
+        return np.repeat(self.values.astype(dtype), np.maximum(counts, 0))
+
+    def __array__(self, dtype=None, copy=None):
+        return self.expand(np.float64 if dtype is None else dtype)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice) and key.step in [None, 1]:
+            start, stop, _ = key.indices(len(self))
+            return self.expand(start=start, stop=max(start, stop))
+        return self.expand()[key]
+
+
+def get_row_weights(weights):
+    """Return one float32 weight per row, as LightGBM stores them."""
+    return np.asarray(weights, dtype=np.float32)
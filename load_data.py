@@ -1,16 +1,54 @@
+import hashlib
 import io
+import json
 import os
 import pickle
 import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from time import time
 
+from .cache import is_columnar
+from .cache import load_manifest
+from .cache import read_examples
+from .cache import read_header
+from .cache import update_manifest
+from .cache import write_columnar
+from .file_weights import FileWeights
+from .metrics import METRIC_NAMES
+from .provenance import save_provenance
+from .score_store import write_scores
+
 
 DEBUG = False
 
 NUM_COLS = 36
 TYPE_INDEX = 35
+LABEL_INDEX = 4
+CORRUPT_SIGD = '9999'
 REMOVED_FEATURES = [3, 4, 5, 7]
-REMOVED_FEATURES_FROM_BIN = []
+FEATURE_INDEX = [i for i in range(NUM_COLS) if i not in REMOVED_FEATURES]
+# Longitude, latitude, the measured and the predicted depth, the row metadata of the score store
+META_COLUMNS = FEATURE_INDEX[:4]
+# All columns but the label are cached, and the feature sets are read from the caches
+CACHE_COLUMNS = [i for i in range(NUM_COLS) if i != LABEL_INDEX]
+# Named feature sets (column indices), more can be defined in `feature_sets` of config.json
+FEATURE_SETS = {
+    "default": FEATURE_INDEX,
+    "all": CACHE_COLUMNS,
+}
+# The columns parsed as numbers from the text, the sigd column takes the place of the kind
+# (the last of CACHE_COLUMNS), which is mapped from its letters
+TEXT_COLUMNS = CACHE_COLUMNS[:-1] + [LABEL_INDEX]
+assert(CACHE_COLUMNS[-1] == TYPE_INDEX)
+# The whitespace bytes other than the tabs and the line breaks of the plain text blocks
+OTHER_WHITESPACE = [b' ', b'\r', b'\x0b', b'\x0c']
+# `year` and `kind` of the rows that come with only NUM_COLS - 2 columns
+SHORT_ROW_PADDING = [b'nan', b'X']
+TEXT_BLOCK_SIZE = 64 * 1024 * 1024
+# The loaded datasets are float32, the caches keep the float64 values as parsed
+DATASET_DTYPE = np.dtype('<f4')
+DATASET_LABEL_DTYPE = np.dtype('i1')
 
 MAX_NUM_EXAMPLES_PER_PICKLE = 1000000
 if DEBUG:
@@ -19,7 +57,10 @@ MAX_WEIGHT = 1.0 / 100000.0
 BINARY_DIR = "runtime_data"
 MODEL_DIR = "runtime_models"
 SCORES_DIR = "runtime_scores"
-INVENTORY = os.path.join(BINARY_DIR, "inventory_{}.txt")
+MANIFEST = os.path.join(BINARY_DIR, "manifest_{}.json")
+CACHE_EXT = ".col"
+EVAL_MATRIX_COLUMNS = ["model_region", "data_region", "size", "model_size"] + METRIC_NAMES
+LEGACY_CACHE_EXT = ".pkl"
 
 data_type = {
     "M": 1,  # - multibeam
@@ -29,6 +70,10 @@ data_type = {
     "X": np.nan,
     'nan': np.nan,
 }
+# The codes of `data_type` by the byte of their letter, -1 for the unknown letters
+KIND_CODES = np.full(256, -1.0)
+KIND_CODES[[ord(kind) for kind in data_type if len(kind) == 1]] = \
+    [code for kind, code in data_type.items() if len(kind) == 1]
 
 inst_weights = {
     'AGSO': 13760454.0,
@@ -52,7 +97,176 @@ def init_setup(base_dir):
 
 # cols[4] == 9999, the instance is corrupted, set label to 0
 # otherwise, the instance is good, set the label to 1
-def read_data_from_text(filename, get_label=lambda cols: cols[4] != '9999'):
+def read_data_from_text(filename, block_size=TEXT_BLOCK_SIZE, hasher=None):
+    features = []
+    labels = []
+    incorrect_cols = 0
+    with open(filename.strip(), 'rb') as fread:
+        for block in iter_text_blocks(fread, block_size):
+            if hasher is not None:
+                hasher.update(block)
+            block_features, block_labels, block_incorrect = parse_text_block(block)
+            features.append(block_features)
+            labels.append(block_labels)
+            incorrect_cols += block_incorrect
+    if len(features) == 1:
+        features, labels = features[0], labels[0]
+    elif len(features) == 0:
+        features = np.empty((0, len(CACHE_COLUMNS)), dtype=np.float64)
+        labels = np.empty(0, dtype=bool)
+    else:
+        features = np.concatenate(features, axis=0)
+        labels = np.concatenate(labels)
+    weights = np.ones(labels.shape[0])
+    return (features, labels, weights, incorrect_cols)
+
+
+def iter_text_blocks(fread, block_size=TEXT_BLOCK_SIZE):
+    # Yield blocks of about `block_size` bytes that always end on a line break
+    remainder = b''
+    while True:
+        chunk = fread.read(block_size)
+        if not chunk:
+            break
+        chunk = remainder + chunk
+        cut = chunk.rfind(b'\n') + 1
+        if cut == 0:
+            remainder = chunk
+            continue
+        remainder = chunk[cut:]
+        yield chunk[:cut]
+    if remainder:
+        yield remainder
+
+
+def parse_text_block(block):
+    if not block.strip():
+        return (np.empty((0, len(CACHE_COLUMNS))), np.empty(0, dtype=bool), 0)
+    if _is_tab_separated(block):
+        try:
+            return _load_text_table(block, '\t') + (0,)
+        except ValueError:
+            # Lines with missing and extra columns that add up, or with empty columns,
+            # which are counted below
+            pass
+    # Only the malformed and the short lines are handled apart, the block is parsed once
+    block, incorrect_cols = _clean_text_block(block)
+    if not block:
+        return (np.empty((0, len(CACHE_COLUMNS))), np.empty(0, dtype=bool), incorrect_cols)
+    # The lines have NUM_COLS columns now, and the short ones are padded with tabs
+    if _has_only_tabs(block):
+        try:
+            return _load_text_table(block, '\t') + (incorrect_cols,)
+        except ValueError:
+            pass
+    return _load_text_table(block) + (incorrect_cols,)
+
+
+def _is_tab_separated(block):
+    """Check that the lines may all be NUM_COLS columns separated by single tabs.
+
+    Only the tabs and the line breaks are counted, over the whole block. The
+    lines that pass by chance have a column too few, which fails to parse.
+    """
+    if not _has_only_tabs(block):
+        return False
+    buf = np.frombuffer(block, dtype=np.uint8)
+    num_lines = np.count_nonzero(buf == ord('\n')) + (buf[-1] != ord('\n'))
+    return np.count_nonzero(buf == ord('\t')) == (NUM_COLS - 1) * num_lines
+
+
+def _has_only_tabs(block):
+    # The columns may only be separated by tabs, the block has no other whitespace
+    return not any(space in block for space in OTHER_WHITESPACE)
+
+
+def _load_text_table(block, delimiter=None):
+    """Parse the lines of NUM_COLS columns of `block`, return `(features, labels)`.
+
+    The numbers are parsed by `np.loadtxt`, the labels are compared on the
+    parsed sigd, and the kinds are looked up from the bytes of their letters.
+    """
+    buf = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(buf == ord('\n'))
+    if buf[-1] != ord('\n'):
+        ends = np.append(ends, len(buf))
+    table = np.loadtxt(io.BytesIO(block), dtype=np.float64, delimiter=delimiter, comments=None,
+                       usecols=TEXT_COLUMNS, ndmin=2)
+    if table.shape[0] != len(ends):
+        raise ValueError("{} lines are empty".format(len(ends) - table.shape[0]))
+    labels = table[:, -1] != float(CORRUPT_SIGD)
+    table[:, -1] = _get_kinds(buf, ends)
+    return (table, labels)
+
+
+def _get_kinds(buf, ends):
+    # The kind is the last column of the lines ending at `ends`, a letter of `data_type` or nan
+    last = ends - 1
+    trailing = np.flatnonzero(_is_space(buf[last]))
+    while len(trailing) > 0:
+        last[trailing] -= 1
+        trailing = trailing[_is_space(buf[last[trailing]])]
+    kinds = KIND_CODES[buf[last]]
+    is_letter = _is_space(buf[last - 1])
+    is_nan = ~is_letter & _is_space(buf[last - 3])
+    for offset, char in enumerate(b'nan'):
+        is_nan &= buf[last - 2 + offset] == char
+    kinds[is_nan] = np.nan
+    unknown = np.flatnonzero(~is_nan & (~is_letter | (kinds < 0)))
+    if len(unknown) > 0:
+        raise ValueError("unknown data type in line {} of the block".format(unknown[0] + 1))
+    return kinds
+
+
+def _is_space(buf):
+    # The bytes that `bytes.split` separates on, a space or one of \t \n \x0b \x0c \r (9 to 13,
+    # the smaller bytes wrap around in the uint8 subtraction)
+    return (buf == ord(' ')) | (buf - 9 < 5)
+
+
+def _count_line_fields(block):
+    """Return the start, the end and the number of fields (as `line.split()`) of every line."""
+    buf = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(buf == ord('\n'))
+    if len(buf) > 0 and buf[-1] != ord('\n'):
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    is_space = _is_space(buf)
+    # A field starts at a non-space byte that follows a space or the start of the block
+    field_starts = ~is_space
+    field_starts[1:] &= is_space[:-1]
+    field_starts = np.flatnonzero(field_starts)
+    counts = np.searchsorted(field_starts, ends) - np.searchsorted(field_starts, starts)
+    return (starts, ends, counts)
+
+
+def _clean_text_block(block):
+    """Drop the lines without NUM_COLS or NUM_COLS - 2 columns, and pad the short lines.
+
+    The lines are counted with NumPy, and only the offending lines are
+    visited in Python, the others are copied as whole runs of lines.
+    """
+    starts, ends, counts = _count_line_fields(block)
+    bad_lines = np.flatnonzero(counts != NUM_COLS)
+    if len(bad_lines) == 0:
+        return (block, 0)
+    padding = b'\t' + b'\t'.join(SHORT_ROW_PADDING) + b'\n'
+    pieces = []
+    cursor = 0
+    incorrect_cols = 0
+    for i in bad_lines:
+        pieces.append(block[cursor:starts[i]])
+        if counts[i] == NUM_COLS - 2:
+            pieces.append(block[starts[i]:ends[i]].rstrip() + padding)
+        else:
+            incorrect_cols += 1
+        cursor = ends[i] + 1
+    pieces.append(block[cursor:])
+    return (b''.join(pieces), incorrect_cols)
+
+
+# The original line-by-line parser, kept as the reference for `parse_text_block`
+def read_data_from_text_by_line(filename, get_label=lambda cols: cols[4] != '9999'):
     features = []
     labels = []
     filename = filename.strip()
@@ -64,11 +278,11 @@ def read_data_from_text(filename, get_label=lambda cols: cols[4] != '9999'):
                 incorrect_cols += 1
                 continue
             if len(cols) == NUM_COLS - 2:
-                cols = ["X"] * 2
+                cols += [col.decode() for col in SHORT_ROW_PADDING]
             cols[TYPE_INDEX] = data_type[cols[TYPE_INDEX]]
             labels.append(get_label(cols))
             features.append(np.array(
-                [float(cols[i]) for i in range(len(cols)) if i not in REMOVED_FEATURES]
+                [float(cols[i]) for i in CACHE_COLUMNS]
             ))
     assert(len(features) == len(labels))
     # weights = np.ones_like(labels) * max(MAX_WEIGHT, 1.0 / max(1.0, len(labels)))
@@ -76,91 +290,320 @@ def read_data_from_text(filename, get_label=lambda cols: cols[4] != '9999'):
     return (features, labels, weights.tolist(), incorrect_cols)
 
 
-def read_data_from_binary(filename):
-    with open(filename, 'rb') as f:
-        features, labels, weights = pickle.load(f)
+def get_feature_columns(config):
+    """Return the columns of the feature set named by `feature_set` in the config."""
+    feature_sets = dict(FEATURE_SETS, **config.get("feature_sets", {}))
+    name = config.get("feature_set", "default")
+    if name not in feature_sets:
+        raise ValueError("unknown feature set {}, choose from {}".format(
+            name, ", ".join(sorted(feature_sets))))
+    columns = [int(column) for column in feature_sets[name]]
+    unknown = [column for column in columns if column not in CACHE_COLUMNS]
+    if unknown:
+        raise ValueError("feature set {} has columns that are not cached, {}".format(name, unknown))
+    return columns
+
+
+def get_column_positions(cache_columns, columns):
+    """Return the positions of `columns` in a cache with `cache_columns`."""
+    missing = [column for column in columns if column not in cache_columns]
+    if missing:
+        raise ValueError("columns {} are not in the cache".format(missing))
+    return [cache_columns.index(column) for column in columns]
+
+
+def _get_binary_file(filename):
+    if not os.path.exists(filename) and filename.endswith(CACHE_EXT):
+        # Fall back to the pickle cache written by the older versions
+        legacy_filename = filename[:-len(CACHE_EXT)] + LEGACY_CACHE_EXT
+        if os.path.exists(legacy_filename):
+            return legacy_filename
+    return filename
+
+
+def read_data_from_binary(filename, columns=None):
+    """Read a cache file, memory-mapped, with only `columns` if they are given.
+
+    The requested columns are copied out of the column-major cache, unless
+    they are a contiguous run of its columns, which is a view of the cache.
+    The other columns are not read.
+    """
+    filename = _get_binary_file(filename)
+    features, labels, weights = read_examples(filename)
+    if columns is not None:
+        positions = get_column_positions(get_cache_columns(filename)[1], columns)
+        if positions and positions == list(range(positions[0], positions[0] + len(positions))):
+            features = features[:, positions[0]:positions[0] + len(positions)]
+        else:
+            features = features[:, positions]
     return (features, labels, weights, 0)
 
 
-def write_data_to_binary(base_dir, st, features, labels, weights, filename, prefix):
-    with open(filename, 'wb') as f:
-        pickle.dump((features[st:], labels[st:], weights[st:]), f, protocol=4)
-    inv_filename = os.path.join(base_dir, INVENTORY.format(prefix))
-    with open(inv_filename, 'a') as f:
-        f.write(filename.strip() + '\n')
+def write_data_to_binary(features, labels, filename):
+    write_columnar(filename, features, labels, columns=CACHE_COLUMNS)
 
 
-def get_datasets(region_str, base_dir, filepaths, is_read_text, prefix, logger):
-    data_features = []
-    data_labels = []
-    data_weights = []
-    source_filename = []
-    last_written_length = 0
-    for filename in filepaths:
-        filename = filename.strip()
+def get_manifest_path(base_dir, prefix):
+    return os.path.join(base_dir, MANIFEST.format(prefix))
+
+
+def ingest_text_file(base_dir, prefix, filename):
+    """Parse a text file and write it to its binary cache.
+
+    Runs in the worker processes of the parallel ingestion, so it reports back
+    instead of logging.
+
+    Returns
+    -------
+    result : tuple
+        ``(filename, info, error)`` where ``info`` is ``(bin_filename, incorrect_cols,
+        entry)`` and ``entry`` is the manifest entry of the cache file, or None if
+        the file failed to load.
+    """
+    filename = filename.strip()
+    bin_filename = get_binary_filename(base_dir, prefix, filename)
+    try:
+        stat = os.stat(filename)
+        hasher = hashlib.sha1()
+        features, labels, _, incorrect_cols = read_data_from_text(filename, hasher=hasher)
+        write_data_to_binary(features, labels, bin_filename)
+    except Exception as err:
+        return (filename, None, err)
+    entry = {
+        "source": filename,
+        "rows": features.shape[0],
+        "cols": features.shape[1],
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha1": hasher.hexdigest(),
+    }
+    return (filename, (bin_filename, incorrect_cols, entry), None)
+
+
+def file_sha1(filename, block_size=TEXT_BLOCK_SIZE):
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def is_cache_fresh(filename, bin_filename, entry):
+    """Check if the cache of a text file is still valid, may refresh `entry` in place.
+
+    The cache is valid if it was written from a file with the same size and
+    content. The content hash is only computed when the size matches but the
+    modification time does not. A cache whose text file is gone is always
+    valid, even without a manifest entry (e.g. converted from a pickle).
+    """
+    if not os.path.exists(bin_filename):
+        return False
+    if not os.path.exists(filename):
+        # The source is gone, nothing to compare against
+        return True
+    if entry is None or "sha1" not in entry:
+        return False
+    stat = os.stat(filename)
+    if stat.st_size != entry["size"]:
+        return False
+    if stat.st_mtime_ns == entry["mtime_ns"]:
+        return True
+    if file_sha1(filename) != entry["sha1"]:
+        return False
+    entry["mtime_ns"] = stat.st_mtime_ns
+    return True
+
+
+def iter_ingested_files(base_dir, filepaths, prefix, num_workers=1, max_inflight=None):
+    """Ingest the files in a process pool, and yield the results in the order of `filepaths`.
+
+    At most `max_inflight` files (default ``2 * num_workers``) are parsed or
+    waiting to be consumed at any time, which bounds the peak memory.
+    """
+    if num_workers <= 1:
+        for filename in filepaths:
+            yield ingest_text_file(base_dir, prefix, filename)
+        return
+    if max_inflight is None:
+        max_inflight = 2 * num_workers
+    max_inflight = max(1, max_inflight)
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        pending = deque()
+        for filename in filepaths:
+            if len(pending) >= max_inflight:
+                yield pending.popleft().result()
+            pending.append(pool.submit(ingest_text_file, base_dir, prefix, filename))
+        while pending:
+            yield pending.popleft().result()
+
+
+def get_cache_columns(bin_filename):
+    """Return `(rows, columns)` of a cache file, `columns` are the indices of the text columns."""
+    bin_filename = _get_binary_file(bin_filename)
+    if not is_columnar(bin_filename):
+        # Legacy pickle caches have no header, they have to be loaded to be counted
+        features, _, _ = read_examples(bin_filename)
+        return (features.shape[0], FEATURE_INDEX[:features.shape[1]])
+    header = read_header(bin_filename)
+    return (header["rows"], header["columns"])
+
+
+def get_region_name(filename):
+    for t in inst_weights:
+        if t in filename:
+            return t
+    return None
+
+
+def get_file_weight(filename):
+    return 1.0 / inst_weights[get_region_name(filename)]
+
+
+def get_caches(base_dir, filepaths, read_mode, prefix, logger, num_workers=1, max_inflight=None,
+               columns=None):
+    """Find the cache files of `filepaths`, and parse the text files into caches if needed.
+
+    With `columns`, the caches written without some of these columns are
+    parsed again in the "auto" read mode, and skipped otherwise.
+
+    Returns
+    -------
+    caches : list
+        ``(filename, bin_filename, rows, cache_columns)`` of every cache file with
+        rows, in the order of `filepaths`.
+    manifest : dict
+        The manifest of the caches of `prefix`.
+    num_parsed : int
+        The number of text files that were parsed.
+    """
+    manifest = load_manifest(get_manifest_path(base_dir, prefix))
+    # Only the entries written by this call are saved, other tasks may share the manifest
+    updated = {}
+    filepaths = [filename.strip() for filename in filepaths]
+    caches = [None] * len(filepaths)
+    to_ingest = []
+    for index, filename in enumerate(filepaths):
         bin_filename = get_binary_filename(base_dir, prefix, filename)
-        if not is_read_text:
-            filename = bin_filename
+        entry = manifest["files"].get(os.path.basename(bin_filename))
+        # Cache files listed directly (e.g. written by tools/chunk_data.py) are never parsed
+        is_listed_cache = bin_filename == filename
+        mtime_ns = entry and entry.get("mtime_ns")
+        if not is_listed_cache and (read_mode == "tsv" or (
+                read_mode == "auto" and not is_cache_fresh(filename, bin_filename, entry))):
+            to_ingest.append(index)
+            continue
+        if entry and entry.get("mtime_ns") != mtime_ns:
+            updated[os.path.basename(bin_filename)] = entry
         try:
-            if is_read_text:
-                features, labels, weights, incorrect_cols = read_data_from_text(filename)
-            else:
-                features, labels, weights, incorrect_cols = read_data_from_binary(filename)
-            logger.log("loaded, {}, incorrect cols, {}, corrupt, {}, size, {}, dim, {}".format(
-                filename, incorrect_cols, np.sum(labels), len(features), features[0].shape[0]))
+            rows, cache_columns = get_cache_columns(bin_filename)
+            if columns is not None:
+                get_column_positions(cache_columns, columns)
         except Exception as err:
+            if read_mode == "auto" and not is_listed_cache and os.path.exists(filename):
+                to_ingest.append(index)
+                continue
+            logger.log("Failed to load {}, read_mode, {}, Error, {}".format(
+                bin_filename, read_mode, err))
+            continue
+        source = filename if read_mode == "auto" else bin_filename
+        caches[index] = (source, bin_filename, rows, cache_columns)
+    if read_mode == "auto":
+        logger.log("{} of {} files are cached, {} to parse".format(
+            len(filepaths) - len(to_ingest), len(filepaths), len(to_ingest)))
+
+    ingested_files = iter_ingested_files(
+        base_dir, [filepaths[index] for index in to_ingest], prefix, num_workers, max_inflight)
+    for index, (filename, info, err) in zip(to_ingest, ingested_files):
+        if err is not None:
             # Print error message only if we are supposed to read this file
-            logger.log("Failed to load {}, is_read_text, {}, Error, {}".format(
-                filename, is_read_text, err))
+            logger.log("Failed to load {}, read_mode, {}, Error, {}".format(
+                filename, read_mode, err))
             continue
-
-        region_name = None
-        for t in inst_weights:
-            if t in filename:
-                region_name = t
-                break
-        weights = np.ones_like(weights) / inst_weights[region_name]
-        data_features  += features
-        data_labels    += labels
-        data_weights   += weights.tolist()
-        source_filename += [filename] * len(features)
-
-        curr_num_examples = len(data_features)
-        if is_read_text:  # and curr_num_examples - last_written_length >= MAX_NUM_EXAMPLES_PER_PICKLE:
-            logger.log("To write {} examples".format(curr_num_examples - last_written_length))
-            write_data_to_binary(
-                base_dir, last_written_length, data_features, data_labels, data_weights,
-                bin_filename, prefix)
-            last_written_length = curr_num_examples
-
-    # Format labels and weights
-    data_features = np.array(data_features)
-    data_labels   = (np.array(data_labels) > 0).astype(np.int8)
-    data_weights  = np.array(data_weights)
-    with open("sources-{}.txt".format(region_str), "w") as f:
-        f.write("\n".join(source_filename))
-    # Remove unwanted features when reading from the binary form
-    if not is_read_text:
-        mask = np.ones(shape=data_features.shape[1]).astype(bool)
-        for i in REMOVED_FEATURES_FROM_BIN:
-            mask[i] = False
-        data_features = data_features[:, mask]
+        bin_filename, incorrect_cols, entry = info
+        logger.log("Wrote {} examples, {}, incorrect cols, {}".format(
+            entry["rows"], filename, incorrect_cols))
+        updated[os.path.basename(bin_filename)] = entry
+        caches[index] = (filename, bin_filename, entry["rows"], CACHE_COLUMNS)
+    if read_mode != "pickle" and updated:
+        manifest = update_manifest(get_manifest_path(base_dir, prefix), updated)
+    caches = [cache for cache in caches if cache is not None]
+    for filename, _, rows, _ in caches:
+        if rows == 0:
+            logger.log("Failed to load {}, read_mode, {}, Error, {}".format(
+                filename, read_mode, "no valid rows"))
+    caches = [cache for cache in caches if cache[2] > 0]
+    return (caches, manifest, len(to_ingest))
+
+
+def get_sources(caches, manifest):
+    # The source file of each cache, for the provenance index
+    sources = []
+    for filename, bin_filename, _, _ in caches:
+        entry = manifest["files"].get(os.path.basename(bin_filename), {})
+        sources.append(entry.get("source") or filename)
+    return sources
+
+
+def get_datasets(region_str, base_dir, filepaths, read_mode, prefix, logger,
+                 num_workers=1, max_inflight=None, columns=None):
+    """Load the examples of `filepaths` with the feature `columns` (default `FEATURE_INDEX`).
+
+    Returns
+    -------
+    data : tuple
+        ``(features, labels, weights)``, float32 features, int8 labels and the
+        `FileWeights` of the files.
+    """
+    start_time = time()
+    if columns is None:
+        columns = FEATURE_INDEX
+    # First pass, find the cache files and their sizes, parse the text files if needed
+    caches, manifest, num_parsed = get_caches(
+        base_dir, filepaths, read_mode, prefix, logger, num_workers, max_inflight, columns)
+
+    # Second pass, allocate the dataset once and copy the columns of each cache file into place
+    num_rows = sum(cache[2] for cache in caches)
+    data_features = np.empty((num_rows, len(columns)), dtype=DATASET_DTYPE)
+    data_labels   = np.empty(num_rows, dtype=DATASET_LABEL_DTYPE)
+    data_weights  = FileWeights([get_file_weight(cache[0]) for cache in caches],
+                                [cache[2] for cache in caches])
+    st = 0
+    for filename, bin_filename, rows, cache_columns in caches:
+        features, labels, _, _ = read_data_from_binary(bin_filename)
+        if features.shape != (rows, len(cache_columns)):
+            raise ValueError("{} has shape {}, expected ({}, {})".format(
+                bin_filename, features.shape, rows, len(cache_columns)))
+        ed = st + rows
+        # One contiguous column of the cache at a time, the other columns are not read
+        for j, position in enumerate(get_column_positions(cache_columns, columns)):
+            data_features[st:ed, j] = features[:, position]
+        data_labels[st:ed]   = labels > 0
+        logger.log("loaded, {}, corrupt, {}, size, {}, dim, {}".format(
+            filename, rows - np.sum(data_labels[st:ed]), rows, len(columns)))
+        st = ed
+
+    # Record the source file of each block of rows
+    save_provenance(get_provenance_path(base_dir, prefix, region_str),
+                    get_sources(caches, manifest), [cache[2] for cache in caches])
     logger.log("Dataset is loaded, size {}".format(data_features.shape))
+    logger.record("load", prefix=prefix, region=region_str, read_mode=read_mode,
+                  files=len(caches), parsed_files=num_parsed, rows=num_rows,
+                  seconds=time() - start_time)
     return (data_features, data_labels, data_weights)
 
 
 def get_binary_filename(base_dir, prefix, filename):
-    if filename.endswith(".pkl"):
+    if filename.endswith(CACHE_EXT) or filename.endswith(LEGACY_CACHE_EXT):
         return filename
     while prefix and prefix.endswith('_'):
         prefix = prefix[:-1]
     basename = os.path.basename(filename)
     dirname = os.path.basename(os.path.dirname(filename))
-    filename = prefix + '_' + dirname + '_' + basename + ".pkl"
+    filename = prefix + '_' + dirname + '_' + basename + CACHE_EXT
     return os.path.join(base_dir, os.path.join(BINARY_DIR, filename))
 
 
-def get_region_data(base_dir, files, regions, is_read_text, prefix, logger):
+def get_region_files(files, regions):
     def get_files(region):
         return [filepath for filepath in files
                 if "/{}/".format(region) in filepath]
@@ -168,7 +611,47 @@ def get_region_data(base_dir, files, regions, is_read_text, prefix, logger):
     region_files = []
     for t in regions:
         region_files += get_files(t)
-    return get_datasets(regions[0], base_dir, region_files, is_read_text, prefix, logger)
+    return region_files
+
+
+def get_region_data(base_dir, files, regions, read_mode, prefix, logger,
+                    num_workers=1, max_inflight=None, columns=None):
+    region_files = get_region_files(files, regions)
+    region_str = regions[0] if len(regions) == 1 else "all"
+    return get_datasets(region_str, base_dir, region_files, read_mode, prefix, logger,
+                        num_workers, max_inflight, columns)
+
+
+def get_binned_dataset_key(base_dir, filepaths, prefix, params, reference_key=None,
+                           columns=FEATURE_INDEX):
+    """Hash the inputs of a binned LightGBM dataset.
+
+    The key covers the file list (with the size and modification time of each
+    source file, or of its cache if the source is not available), the feature
+    columns and their dtype, the binning parameters and, for a dataset binned
+    with the bin mappers of another one, the key of that reference dataset.
+    """
+    files = []
+    for filename in filepaths:
+        filename = filename.strip()
+        path = filename
+        if not os.path.exists(path):
+            path = get_binary_filename(base_dir, prefix, filename)
+        stat = os.stat(path) if os.path.exists(path) else None
+        files.append([filename, stat and stat.st_size, stat and stat.st_mtime_ns])
+    key = {
+        "files": files,
+        "features": list(columns),
+        "dtype": DATASET_DTYPE.str,
+        "params": params,
+        "reference": reference_key,
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def get_binned_dataset_path(base_dir, prefix, region_str, key):
+    dir_path = os.path.join(base_dir, BINARY_DIR)
+    return os.path.join(dir_path, 'lgb_{}_{}_{}.bin'.format(prefix, region_str, key))
 
 
 def get_model_path(base_dir, region):
@@ -176,30 +659,81 @@ def get_model_path(base_dir, region):
     return os.path.join(dir_path, '{}_model.pkl'.format(region))
 
 
-def get_prediction_path(base_dir, model_region, test_region):
+def get_checkpoint_path(base_dir, region):
+    dir_path = os.path.join(base_dir, MODEL_DIR)
+    return os.path.join(dir_path, '{}_checkpoint.txt'.format(region))
+
+
+def get_eval_matrix_path(base_dir, name):
     dir_path = os.path.join(base_dir, SCORES_DIR)
-    return os.path.join(dir_path, 'model_{}_test_{}_scores.pkl'.format(model_region, test_region))
+    return os.path.join(dir_path, 'eval_matrix_{}.tsv'.format(name))
+
 
+def persist_eval_matrix(base_dir, name, results):
+    # `results` maps (model_region, test_region) to (size, model_size, *METRIC_NAMES)
+    lines = ["\t".join(EVAL_MATRIX_COLUMNS)]
+    for (model_region, test_region), metrics in sorted(results.items()):
+        lines.append("\t".join([model_region, test_region] + [str(t) for t in metrics]))
+    with open(get_eval_matrix_path(base_dir, name), 'w') as f:
+        f.write("\n".join(lines) + "\n")
 
-def persist_predictions(base_dir, model_region, test_region, features, label, scores, weights):
-    with open(get_prediction_path(base_dir, model_region, test_region), 'wb') as fout:
-        pickle.dump((features[:, :4], label, scores, weights), fout)
+
+def get_provenance_path(base_dir, prefix, region):
+    dir_path = os.path.join(base_dir, SCORES_DIR)
+    return os.path.join(dir_path, 'sources_{}_{}.json'.format(prefix, region))
+
+
+def persist_predictions(base_dir, model_region, test_region, meta, label, scores, weights):
+    # `meta` has the `META_COLUMNS` of the rows, not the features of the model
+    write_scores(base_dir, model_region, test_region, meta, label, scores, weights)
+
+
+def get_text_model_path(pkl_model_path):
+    return pkl_model_path.rsplit('.', 1)[0] + ".txt"
 
 
 def persist_model(base_dir, region, gbm):
     pkl_model_path = get_model_path(base_dir, region)
-    txt_model_path = pkl_model_path.rsplit('.', 1)[0] + ".txt"
+    txt_model_path = get_text_model_path(pkl_model_path)
     with open(pkl_model_path, 'wb') as fout:
         pickle.dump(gbm, fout)
     gbm.save_model(txt_model_path)
 
 
-def _load_inventory(base_dir, is_read_text, prefix):
-    if is_read_text:
-        filename = os.path.join(base_dir, INVENTORY.format(prefix))
-        f = open(filename, 'w')
-        f.close()
+def _load_inventory(base_dir, read_mode, prefix):
+    if read_mode == "tsv":
         return []
-    filename = os.path.join(base_dir, INVENTORY.format(prefix))
-    with open(filename) as f:
-        return [line.strip() for line in f.readlines()]
+    filename = get_manifest_path(base_dir, prefix)
+    return [os.path.join(base_dir, BINARY_DIR, cache_name)
+            for cache_name in sorted(load_manifest(filename)["files"])]
+
+
+def convert_pickle_caches(base_dir, logger, remove=False):
+    """Convert the pickle caches under `BINARY_DIR` to the columnar format."""
+    dirname = os.path.join(base_dir, BINARY_DIR)
+    entries = {}
+    for name in sorted(os.listdir(dirname)):
+        if not name.endswith(LEGACY_CACHE_EXT):
+            continue
+        pkl_filename = os.path.join(dirname, name)
+        bin_filename = pkl_filename[:-len(LEGACY_CACHE_EXT)] + CACHE_EXT
+        try:
+            features, labels, _, _ = read_data_from_binary(pkl_filename)
+            # The pickle caches have the columns of `FEATURE_INDEX`, not all columns
+            write_columnar(bin_filename, features, labels,
+                           columns=get_cache_columns(pkl_filename)[1])
+        except Exception as err:
+            logger.log("Failed to convert {}, Error, {}".format(pkl_filename, err))
+            continue
+        prefix = name.split('_', 1)[0]
+        entries.setdefault(prefix, {})[os.path.basename(bin_filename)] = {
+            "source": None,
+            "rows": len(features),
+            "cols": features.shape[1],
+        }
+        logger.log("converted, {}, size, {}".format(pkl_filename, features.shape))
+        if remove:
+            os.remove(pkl_filename)
+    for prefix, prefix_entries in entries.items():
+        # The entries of the caches parsed from their text files are kept
+        update_manifest(get_manifest_path(base_dir, prefix), prefix_entries, overwrite=False)
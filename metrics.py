@@ -0,0 +1,159 @@
+import numpy as np
+
+
+EPS = 1e-15
+NUM_BINS = 100000
+BATCH_SIZE = 1000000
+METRIC_NAMES = [
+    "loss", "auprc", "auroc", "accuracy",
+    "weighted_loss", "weighted_auprc", "weighted_auroc", "weighted_accuracy",
+]
+
+
+def _trapezoid(y, x):
+    return float(np.sum((x[1:] - x[:-1]) * (y[1:] + y[:-1])) / 2.0)
+
+
+def _curve_areas(tps, fps):
+    """AUPRC and AUROC from the cumulative positives and negatives at decreasing thresholds.
+
+    The curves are the same as the ones of `sklearn.metrics.precision_recall_curve`
+    and `sklearn.metrics.roc_curve`, and the areas are computed with the trapezoidal
+    rule as `sklearn.metrics.auc` does.
+    """
+    tps = np.concatenate([[0.0], tps])
+    fps = np.concatenate([[0.0], fps])
+    total_pos, total_neg = tps[-1], fps[-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(tps + fps > 0, tps / (tps + fps), 1.0)
+        recall = tps / total_pos
+        fpr = fps / total_neg
+    auprc = _trapezoid(precision, recall) if total_pos > 0 else np.nan
+    auroc = _trapezoid(recall, fpr) if total_pos > 0 and total_neg > 0 else np.nan
+    return (auprc, auroc)
+
+
+def ranking_metrics(labels, scores, weights=None):
+    """Exact AUPRC and AUROC, unweighted and weighted, with a single sort of the scores."""
+    order = np.argsort(scores, kind='stable')[::-1]
+    sorted_scores = scores[order]
+    positive = labels[order] > 0
+    # The last position of each distinct score is a threshold
+    thresholds = np.append(np.flatnonzero(np.diff(sorted_scores)), len(sorted_scores) - 1)
+    del sorted_scores
+    tps = np.cumsum(positive)[thresholds]
+    fps = thresholds + 1 - tps
+    auprc, auroc = _curve_areas(tps.astype(np.float64), fps.astype(np.float64))
+    if weights is None:
+        weighted_auprc, weighted_auroc = auprc, auroc
+    else:
+        sorted_weights = weights[order]
+        weighted_tps = np.cumsum(np.where(positive, sorted_weights, 0.0))[thresholds]
+        weighted_fps = np.cumsum(np.where(positive, 0.0, sorted_weights))[thresholds]
+        weighted_auprc, weighted_auroc = _curve_areas(weighted_tps, weighted_fps)
+    return {
+        "auprc": auprc,
+        "auroc": auroc,
+        "weighted_auprc": weighted_auprc,
+        "weighted_auroc": weighted_auroc,
+    }
+
+
+class ScoreHistogram:
+    """Accumulate the evaluation metrics of a score vector batch by batch.
+
+    Loss and accuracy are accumulated exactly. AUPRC and AUROC are approximated
+    by putting the scores into `num_bins` equal-width bins over [0, 1], so the
+    memory does not depend on the number of scores.
+    """
+    def __init__(self, num_bins=NUM_BINS):
+        self.num_bins = num_bins
+        self.pos_counts = np.zeros(num_bins)
+        self.neg_counts = np.zeros(num_bins)
+        self.weighted_pos = np.zeros(num_bins)
+        self.weighted_neg = np.zeros(num_bins)
+        self.count = 0
+        self.weight_sum = 0.0
+        self.loss_sum = 0.0
+        self.weighted_loss_sum = 0.0
+        self.num_correct = 0
+        self.weighted_correct = 0.0
+
+    def update(self, labels, scores, weights=None):
+        positive = labels > 0
+        scores = np.clip(scores, EPS, 1.0 - EPS)
+        if weights is None:
+            weights = np.ones(scores.shape[0])
+        loss = -np.log(np.where(positive, scores, 1.0 - scores))
+        correct = positive == (scores > 0.5)
+        bins = np.minimum((scores * self.num_bins).astype(np.int64), self.num_bins - 1)
+        self.pos_counts += np.bincount(bins[positive], minlength=self.num_bins)
+        self.neg_counts += np.bincount(bins[~positive], minlength=self.num_bins)
+        self.weighted_pos += np.bincount(
+            bins[positive], weights=weights[positive], minlength=self.num_bins)
+        self.weighted_neg += np.bincount(
+            bins[~positive], weights=weights[~positive], minlength=self.num_bins)
+        self.count += scores.shape[0]
+        self.weight_sum += float(np.sum(weights))
+        self.loss_sum += float(np.sum(loss))
+        self.weighted_loss_sum += float(np.dot(weights, loss))
+        self.num_correct += int(np.sum(correct))
+        self.weighted_correct += float(np.sum(weights[correct]))
+
+    def ranking_metrics(self):
+        # Walk the bins from the highest scores down, each bin is a threshold
+        auprc, auroc = _curve_areas(
+            np.cumsum(self.pos_counts[::-1]), np.cumsum(self.neg_counts[::-1]))
+        weighted_auprc, weighted_auroc = _curve_areas(
+            np.cumsum(self.weighted_pos[::-1]), np.cumsum(self.weighted_neg[::-1]))
+        return {
+            "auprc": auprc,
+            "auroc": auroc,
+            "weighted_auprc": weighted_auprc,
+            "weighted_auroc": weighted_auroc,
+        }
+
+    def metrics(self, ranking=None):
+        """Return all metrics, using the exact `ranking` metrics if they are given."""
+        if ranking is None:
+            ranking = self.ranking_metrics()
+        count = max(1, self.count)
+        weight_sum = self.weight_sum if self.weight_sum > 0 else 1.0
+        metrics = {
+            "loss": self.loss_sum / count,
+            "accuracy": self.num_correct / count,
+            "weighted_loss": self.weighted_loss_sum / weight_sum,
+            "weighted_accuracy": self.weighted_correct / weight_sum,
+        }
+        metrics.update(ranking)
+        return metrics
+
+
+def evaluate_scores(labels, scores, weights=None, approximate=False, num_bins=NUM_BINS,
+                    batch_size=BATCH_SIZE):
+    """Compute the loss, AUPRC, AUROC and accuracy of the scores, unweighted and weighted.
+
+    Parameters
+    ----------
+    labels : array
+        1 for the positive examples, 0 for the negative ones.
+    scores : array
+        The predicted probabilities of the positive class.
+    weights : array, optional (default=None)
+        The example weights, the weighted metrics equal the unweighted ones if None.
+    approximate : bool, optional (default=False)
+        Approximate AUPRC and AUROC with a `num_bins` score histogram instead of
+        sorting the scores.
+
+    Returns
+    -------
+    metrics : dict
+        Maps each of `METRIC_NAMES` to its value.
+    """
+    histogram = ScoreHistogram(num_bins)
+    for st in range(0, scores.shape[0], batch_size):
+        histogram.update(
+            labels[st:st + batch_size], scores[st:st + batch_size],
+            None if weights is None else weights[st:st + batch_size])
+    ranking = None if approximate else ranking_metrics(labels, scores, weights)
+    return histogram.metrics(ranking)
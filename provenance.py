@@ -0,0 +1,48 @@
+import json
+import os
+import numpy as np
+
+
+# The provenance index of a dataset lists, for each source file in the order the
+# examples were loaded, the first row of the file in the dataset and its row count.
+
+
+def save_provenance(filename, sources, counts):
+    counts = [int(c) for c in counts]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(int).tolist() if counts else []
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'w') as f:
+        json.dump({"sources": list(sources), "starts": starts, "counts": counts}, f)
+    os.replace(tmp_filename, filename)
+
+
+def load_provenance(filename):
+    with open(filename) as f:
+        provenance = json.load(f)
+    return {
+        "sources": np.array(provenance["sources"], dtype=object),
+        "starts": np.array(provenance["starts"], dtype=np.int64),
+        "counts": np.array(provenance["counts"], dtype=np.int64),
+    }
+
+
+def num_rows(provenance):
+    return int(np.sum(provenance["counts"]))
+
+
+def lookup_file_ids(provenance, rows):
+    """Map row indices of the dataset to the ids (positions) of their source files."""
+    rows = np.asarray(rows, dtype=np.int64)
+    if np.any(rows < 0) or np.any(rows >= num_rows(provenance)):
+        raise IndexError("row index out of range of the provenance index")
+    return np.searchsorted(provenance["starts"], rows, side='right') - 1
+
+
+def lookup_sources(provenance, rows):
+    """Map row indices of the dataset to their source filenames."""
+    return provenance["sources"][lookup_file_ids(provenance, rows)]
+
+
+def expand_file_ids(provenance):
+    """Return the source file id of every row, e.g. to join with the score arrays."""
+    return np.repeat(np.arange(len(provenance["counts"])), provenance["counts"])
@@ -0,0 +1,81 @@
+import os
+
+from .load_data import FEATURE_INDEX
+from .load_data import inst_weights
+
+
+# Memory of one example while training: the float32 features, the label, the float32
+# weight of LightGBM, the LightGBM bins, and a margin for the validation data and the
+# parsing buffers
+BYTES_PER_ROW = 2 * (4 * len(FEATURE_INDEX) + 1 + 4 + len(FEATURE_INDEX))
+
+
+def get_num_cpus(config):
+    """Return the number of cores of the machine, capped by `max_cpus` in the config."""
+    num_cpus = os.cpu_count() or 1
+    if config.get("max_cpus"):
+        num_cpus = min(num_cpus, int(config["max_cpus"]))
+    return max(1, num_cpus)
+
+
+def get_region_rows(region):
+    if region == "all":
+        return sum(inst_weights.values())
+    return inst_weights.get(region, 0)
+
+
+def plan_tasks(regions, num_cpus, memory_limit=None, bytes_per_row=BYTES_PER_ROW):
+    """Size the CPUs and the memory of one task per region from its expected row count.
+
+    Each task gets a share of `num_cpus` proportional to its rows (at least 1),
+    so that all tasks take about the same time, and the memory of its rows
+    (at most `memory_limit`).
+
+    Returns
+    -------
+    plans : list
+        ``(region, num_cpus, memory)`` tuples, largest regions first.
+    """
+    rows = {region: get_region_rows(region) for region in regions}
+    total_rows = sum(rows.values())
+    plans = []
+    for region in sorted(regions, key=lambda region: rows[region], reverse=True):
+        share = rows[region] / total_rows if total_rows > 0 else 1.0 / len(regions)
+        cpus = min(num_cpus, max(1, int(round(num_cpus * share))))
+        memory = int(rows[region] * bytes_per_row)
+        if memory_limit:
+            memory = min(memory, int(memory_limit))
+        plans.append((region, cpus, memory))
+    return plans
+
+
+def plan_workers(shard_rows, num_cpus, memory_limit=None, bytes_per_row=BYTES_PER_ROW,
+                 shared_rows=0):
+    """Size the CPUs and the memory of the workers of a distributed training.
+
+    The workers must all run at the same time, so they share `num_cpus` and
+    `memory_limit` evenly. Each worker needs the memory of its shard of rows
+    and of the `shared_rows` that every worker loads (the validation data).
+
+    Returns
+    -------
+    plans : list
+        ``(num_cpus, memory)`` of each worker.
+    """
+    num_workers = max(1, len(shard_rows))
+    cpus = max(1, num_cpus // num_workers)
+    plans = []
+    for rows in shard_rows:
+        memory = int((rows + shared_rows) * bytes_per_row)
+        if memory_limit:
+            memory = min(memory, int(memory_limit) // num_workers)
+        plans.append((cpus, memory))
+    return plans
+
+
+def get_task_config(config, num_threads=None):
+    """Copy the config with `num_thread` set to the CPUs of the task."""
+    config = dict(config)
+    if num_threads:
+        config["num_thread"] = int(num_threads)
+    return config
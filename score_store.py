@@ -0,0 +1,197 @@
+import hashlib
+import os
+import shutil
+import threading
+import numpy as np
+
+from .cache import read_examples
+from .cache import write_columnar
+from .file_weights import FileWeights
+
+
+# Layout of the score store, partitioned by test region and model:
+#   {STORE_DIR}/{test_region}/{fingerprint}/rows.col          the metadata of the rows, once
+#   {STORE_DIR}/{test_region}/{fingerprint}/weights.npz       the weights of the blocks of rows
+#   {STORE_DIR}/{test_region}/{fingerprint}/model_{model}.npy  float32 scores of each model
+# The fingerprint hashes the metadata, so that the scores of a test region always
+# match its rows. The metadata are the `NUM_META_COLUMNS` columns longitude, latitude,
+# measured and predicted depth (whatever the feature set of the models), and the labels. The weights are stored as runs
+# (`FileWeights`), the stores written by the older versions have them in rows.col.
+STORE_DIR = os.path.join("runtime_scores", "store")
+ROWS_FILE = "rows.col"
+WEIGHTS_FILE = "weights.npz"
+SCORES_FORMAT = "model_{}.npy"
+NUM_META_COLUMNS = 4
+SCORE_DTYPE = np.dtype('<f4')
+
+
+def get_store_dir(base_dir):
+    return os.path.join(base_dir, STORE_DIR)
+
+
+def _get_tmp_filename(filename):
+    # Unique per process and thread, as several tasks may write the same partition
+    return "{}.{}.{}".format(filename, os.getpid(), threading.get_ident())
+
+
+def get_fingerprint(meta, labels):
+    hasher = hashlib.sha1()
+    hasher.update(np.ascontiguousarray(meta).tobytes())
+    hasher.update(np.ascontiguousarray(labels).tobytes())
+    return hasher.hexdigest()[:16]
+
+
+def get_partition_dir(base_dir, test_region):
+    """Return the directory of the current rows of `test_region`, or None."""
+    region_dir = os.path.join(get_store_dir(base_dir), test_region)
+    if not os.path.isdir(region_dir):
+        return None
+    partitions = [os.path.join(region_dir, name) for name in os.listdir(region_dir)]
+    partitions = [dir_path for dir_path in partitions
+                  if os.path.exists(os.path.join(dir_path, ROWS_FILE))]
+    if not partitions:
+        return None
+    # The rows written last are the current ones
+    return max(partitions, key=lambda dir_path: os.path.getmtime(os.path.join(dir_path, ROWS_FILE)))
+
+
+def write_scores(base_dir, model_region, test_region, meta, labels, scores, weights):
+    """Add the scores of a model on a test region to the store.
+
+    The metadata of the rows (`meta`, longitude, latitude, measured and predicted depth) are
+    written only by the first model scored on the test region, and keep their
+    dtype. If the rows of the test region changed, the partition of the old
+    rows is removed with their scores.
+    """
+    meta = np.asarray(meta)
+    assert(meta.shape[1] == NUM_META_COLUMNS)
+    labels = np.asarray(labels)
+    region_dir = os.path.join(get_store_dir(base_dir), test_region)
+    dir_path = os.path.join(region_dir, get_fingerprint(meta, labels))
+    rows_filename = os.path.join(dir_path, ROWS_FILE)
+    if not os.path.exists(rows_filename):
+        os.makedirs(dir_path, exist_ok=True)
+        if not isinstance(weights, FileWeights):
+            weights = FileWeights.from_rows(weights)
+        # The weights first, the partition is complete once it has its rows
+        weights_filename = os.path.join(dir_path, WEIGHTS_FILE)
+        tmp_filename = _get_tmp_filename(weights_filename)
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, values=weights.values, counts=weights.counts)
+        os.replace(tmp_filename, weights_filename)
+        tmp_filename = _get_tmp_filename(rows_filename)
+        write_columnar(tmp_filename, meta, labels, dtype=meta.dtype)
+        os.replace(tmp_filename, rows_filename)
+        for name in os.listdir(region_dir):
+            if os.path.join(region_dir, name) != dir_path:
+                shutil.rmtree(os.path.join(region_dir, name), ignore_errors=True)
+    scores = np.asarray(scores, dtype=SCORE_DTYPE).reshape(-1)
+    assert(scores.shape[0] == labels.shape[0])
+    scores_filename = os.path.join(dir_path, SCORES_FORMAT.format(model_region))
+    tmp_filename = _get_tmp_filename(scores_filename)
+    with open(tmp_filename, 'wb') as f:
+        np.save(f, scores)
+    os.replace(tmp_filename, scores_filename)
+
+
+def list_partitions(base_dir):
+    """Map every test region of the store to the sorted list of the models scored on it."""
+    store_dir = get_store_dir(base_dir)
+    partitions = {}
+    if not os.path.isdir(store_dir):
+        return partitions
+    prefix, suffix = SCORES_FORMAT.split("{}")
+    for test_region in sorted(os.listdir(store_dir)):
+        dir_path = get_partition_dir(base_dir, test_region)
+        if dir_path is None:
+            continue
+        partitions[test_region] = sorted(
+            name[len(prefix):-len(suffix)] for name in os.listdir(dir_path)
+            if name.startswith(prefix) and name.endswith(suffix))
+    return partitions
+
+
+def load_rows(base_dir, test_region, rows=None, mmap_mode='r'):
+    """Return `(meta, labels, weights)` of a test region, memory-mapped.
+
+    The weights are a `FileWeights`. `rows` selects some rows (a boolean mask,
+    indices or a slice), which are then read into memory.
+    """
+    dir_path = get_partition_dir(base_dir, test_region)
+    if dir_path is None:
+        raise KeyError("no scores of test region {}".format(test_region))
+    meta, labels, weights = read_examples(os.path.join(dir_path, ROWS_FILE), mmap_mode)
+    weights_filename = os.path.join(dir_path, WEIGHTS_FILE)
+    if os.path.exists(weights_filename):
+        with np.load(weights_filename) as data:
+            weights = FileWeights(data["values"], data["counts"])
+    else:
+        weights = FileWeights.from_rows(weights)
+    if rows is not None:
+        return (meta[rows], labels[rows], weights[rows])
+    return (meta, labels, weights)
+
+
+def load_scores(base_dir, model_region, test_region, rows=None, mmap_mode='r'):
+    """Return the float32 scores of a model on a test region, memory-mapped."""
+    dir_path = get_partition_dir(base_dir, test_region)
+    scores_filename = dir_path and os.path.join(dir_path, SCORES_FORMAT.format(model_region))
+    if scores_filename is None or not os.path.exists(scores_filename):
+        raise KeyError("no scores of model {} on test region {}".format(model_region, test_region))
+    scores = np.load(scores_filename, mmap_mode=mmap_mode)
+    if rows is not None:
+        return scores[rows]
+    return scores
+
+
+def query(base_dir, models=None, regions=None, rows=None, mmap_mode='r'):
+    """Select the scores of some models on some test regions.
+
+    Parameters
+    ----------
+    models, regions : list, optional
+        The model and the test regions to select, all of them if None.
+        Pairs that were not scored are skipped.
+    rows : optional
+        The rows to select in every test region (a boolean mask, indices or a
+        slice), or a function from `(meta, labels, weights)` of a test region
+        to such a selection. All rows are returned memory-mapped if None.
+
+    Returns
+    -------
+    results : dict
+        Maps each test region to ``{"meta", "labels", "weights", "scores"}``,
+        where "scores" maps each model to its scores of the selected rows.
+    """
+    results = {}
+    for test_region, scored_models in list_partitions(base_dir).items():
+        if regions is not None and test_region not in regions:
+            continue
+        selected_models = [model for model in scored_models if models is None or model in models]
+        if not selected_models:
+            continue
+        meta, labels, weights = load_rows(base_dir, test_region, mmap_mode=mmap_mode)
+        selected = rows(meta, labels, weights) if callable(rows) else rows
+        if selected is not None:
+            meta, labels, weights = meta[selected], labels[selected], weights[selected]
+        results[test_region] = {
+            "meta": meta,
+            "labels": labels,
+            "weights": weights,
+            "scores": {model: load_scores(base_dir, model, test_region, selected, mmap_mode)
+                       for model in selected_models},
+        }
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 2:
+        print("Usage: python -m bathymetry.score_store <base_dir>")
+        sys.exit(1)
+    # One "model_region test_region rows" line per scored pair
+    base_dir = os.path.expanduser(sys.argv[1])
+    for test_region, models in list_partitions(base_dir).items():
+        num_rows = load_rows(base_dir, test_region)[1].shape[0]
+        for model_region in models:
+            print("{} {} {}".format(model_region, test_region, num_rows))
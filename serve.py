@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+import numpy as np
+from collections import deque
+from time import time
+
+from .booster import load_model
+from .common import Logger
+from .load_data import CACHE_COLUMNS
+from .load_data import FEATURE_INDEX
+from .load_data import NUM_COLS
+from .load_data import get_column_positions
+from .load_data import get_feature_columns
+from .load_data import get_model_path
+from .load_data import parse_text_block
+
+
+MAX_BATCH_ROWS = 10000
+MAX_WAIT_SECONDS = 0.005
+READ_SIZE = 64 * 1024
+LATENCY_WINDOW = 10000
+STATS_SECONDS = 60.0
+STATS_COMMAND = b"#stats"
+
+
+class MicroBatcher:
+    """Score the rows of concurrent requests in micro-batches with warm models.
+
+    A request is a list of TSV lines. The lines of the requests that arrive
+    within `max_wait` seconds of the first one (up to `max_batch_rows` lines)
+    are parsed as one block and scored by every model at once. The rows
+    with a wrong number of columns get NaN scores, the rows that come without
+    the last two columns are padded as in `read_data_from_text`. If a batch
+    cannot be parsed, its requests are scored one by one, and only the
+    requests that cannot be parsed get NaN scores.
+    """
+
+    def __init__(self, models, max_batch_rows=MAX_BATCH_ROWS, max_wait=MAX_WAIT_SECONDS,
+                 num_threads=0, logger=None, log=None, columns=FEATURE_INDEX):
+        self.models = models
+        self.positions = get_column_positions(CACHE_COLUMNS, columns)
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait
+        self.params = {"num_threads": num_threads} if num_threads > 0 else {}
+        self.logger = logger
+        self.log = log
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.counters = {"requests": 0, "rows": 0, "invalid_rows": 0, "batches": 0, "errors": 0}
+        self.start_time = time()
+        self.last_stats = self.start_time
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def score(self, lines):
+        """Return the `(len(lines), len(models))` scores of the TSV `lines` after their batch."""
+        request = {"lines": lines, "done": threading.Event(), "time": time()}
+        self.queue.put(request)
+        request["done"].wait()
+        return request["scores"]
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            stats = dict(self.counters)
+        seconds = time() - self.start_time
+        stats.update({
+            "seconds": seconds,
+            "rows_per_sec": stats["rows"] / seconds if seconds > 0 else 0.0,
+            "rows_per_batch": stats["rows"] / stats["batches"] if stats["batches"] else 0.0,
+            "p50_ms": float(np.percentile(latencies, 50)) * 1000.0 if len(latencies) else None,
+            "p99_ms": float(np.percentile(latencies, 99)) * 1000.0 if len(latencies) else None,
+        })
+        return stats
+
+    def _run(self):
+        while True:
+            requests = [self.queue.get()]
+            num_rows = len(requests[0]["lines"])
+            deadline = time() + self.max_wait
+            while num_rows < self.max_batch_rows:
+                timeout = deadline - time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                num_rows += len(requests[-1]["lines"])
+            self._score_batch(requests)
+
+    def _predict(self, lines):
+        valid = np.array([len(line.split()) in [NUM_COLS, NUM_COLS - 2] for line in lines],
+                         dtype=bool)
+        scores = np.full((len(lines), len(self.models)), np.nan)
+        if np.any(valid):
+            features, _, _ = parse_text_block(
+                b"\n".join(line for line, is_valid in zip(lines, valid) if is_valid))
+            features = features[:, self.positions]
+            for j, model in enumerate(self.models):
+                scores[valid, j] = model.predict(features, **self.params)
+        return (scores, int(np.sum(~valid)))
+
+    def _score_batch(self, requests):
+        lines = [line for request in requests for line in request["lines"]]
+        try:
+            scores, invalid_rows = self._predict(lines)
+        except Exception as err:
+            if len(requests) > 1:
+                # Only fail the requests with values that cannot be parsed
+                for request in requests:
+                    self._score_batch([request])
+                return
+            if self.log is not None:
+                self.log("Failed to score a request, Error, {}".format(err))
+            scores, invalid_rows = np.full((len(lines), len(self.models)), np.nan), len(lines)
+            with self.lock:
+                self.counters["errors"] += 1
+        now = time()
+        st = 0
+        for request in requests:
+            ed = st + len(request["lines"])
+            request["scores"] = scores[st:ed]
+            request["done"].set()
+            st = ed
+        with self.lock:
+            self.latencies.extend(now - request["time"] for request in requests)
+            self.counters["requests"] += len(requests)
+            self.counters["rows"] += len(lines)
+            self.counters["invalid_rows"] += invalid_rows
+            self.counters["batches"] += 1
+        if now - self.last_stats >= STATS_SECONDS:
+            self.last_stats = now
+            self.report()
+
+    def report(self):
+        stats = self.stats()
+        if self.log is not None:
+            self.log("serving, " + ", ".join(
+                "{}, {}".format(key, value) for key, value in sorted(stats.items())))
+        if self.logger is not None:
+            self.logger.record("serve", **stats)
+
+
+def format_scores(scores):
+    return b"".join(
+        ("\t".join("{:.6g}".format(score) for score in row) + "\n").encode() for row in scores)
+
+
+def serve_stream(read, write, batcher):
+    """Score the TSV lines read with `read(size)` and write one line of scores per row.
+
+    Each line of scores has the tab-separated score of every model, in the
+    order of the models. The line "#stats" is answered with the counters of
+    the batcher as a JSON line.
+    """
+    pending = b""
+    while True:
+        data = read(READ_SIZE)
+        if not data:
+            break
+        lines = (pending + data).split(b"\n")
+        pending = lines.pop()
+        output = []
+        rows = []
+        for line in lines:
+            if line.strip() == STATS_COMMAND:
+                if rows:
+                    output.append(format_scores(batcher.score(rows)))
+                    rows = []
+                output.append((json.dumps(batcher.stats()) + "\n").encode())
+            else:
+                rows.append(line)
+        if rows:
+            output.append(format_scores(batcher.score(rows)))
+        if output:
+            write(b"".join(output))
+    if pending.strip():
+        write(format_scores(batcher.score([pending])))
+
+
+class ScoringHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            serve_stream(self.request.recv, self.request.sendall, self.server.batcher)
+        except Exception as err:
+            self.server.batcher.log("Failed to serve a connection, Error, {}".format(err))
+
+
+class ScoringServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def load_models(base_dir, regions, engine="lightgbm"):
+    return [load_model(get_model_path(base_dir, region), engine) for region in regions]
+
+
+def run_server(batcher, socket_path):
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = ScoringServer(socket_path, ScoringHandler)
+    server.batcher = batcher
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Score TSV rows with the trained models, over a unix socket or stdin")
+    parser.add_argument("config")
+    parser.add_argument("--models", nargs="+", required=True, help="regions of the models")
+    parser.add_argument("--socket", help="path of the unix socket, read stdin if not set")
+    parser.add_argument("--max-batch-rows", type=int, default=MAX_BATCH_ROWS)
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_SECONDS * 1000.0)
+    args = parser.parse_args()
+    with open(args.config) as f:
+        config = json.load(f)
+    base_dir = os.path.expanduser(config["base_dir"])
+
+    logger = Logger()
+    logger.set_file_handle(os.path.join(base_dir, "serving_log.log"))
+    # The scores are written to stdout in the stdin mode, so the log only goes to stderr
+    log = logger.log if args.socket else lambda msg: print(msg, file=sys.stderr)
+    models = load_models(base_dir, args.models, config.get("inference_engine", "lightgbm"))
+    log("loaded models, {}".format(", ".join(args.models)))
+    batcher = MicroBatcher(
+        models, args.max_batch_rows, args.max_wait_ms / 1000.0, config.get("num_thread", 0),
+        logger, log, get_feature_columns(config))
+    try:
+        if args.socket:
+            run_server(batcher, args.socket)
+        else:
+            stdout = sys.stdout.buffer
+
+            def write(data):
+                stdout.write(data)
+                stdout.flush()
+            serve_stream(sys.stdin.buffer.read1, write, batcher)
+    except KeyboardInterrupt:
+        pass
+    batcher.report()
+    logger.flush()
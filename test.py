@@ -1,13 +1,18 @@
 import os
 import pickle
 import numpy as np
-from sklearn.metrics import auc
-from sklearn.metrics import precision_recall_curve
-from sklearn.metrics import roc_curve
+from concurrent.futures import ThreadPoolExecutor
 
+from .booster import PREDICT_BATCH_SIZE
 from .booster import get_scores
+from .booster import load_model
+from .booster import score_model
+from .load_data import META_COLUMNS
+from .load_data import get_column_positions
+from .load_data import get_feature_columns
 from .load_data import get_region_data
 from .load_data import get_model_path
+from .load_data import persist_eval_matrix
 from .load_data import persist_predictions
 from .tools.split_by_instances import load_examples_from_pickle
 
@@ -16,7 +21,7 @@ TEST_PREFIX = "test"
 LIMIT = None
 
 
-def run_testing(config, models, regions, is_read_text, test_mode, logger, all_data=None):
+def run_testing(config, models, regions, read_mode, test_mode, logger, all_data=None):
     base_dir = config["base_dir"]
     logger.log("start testing")
     with open(config["testing_files"]) as f:
@@ -31,8 +36,8 @@ def run_testing(config, models, regions, is_read_text, test_mode, logger, all_da
                 logger.log("Model {} does not exist.".format(model_name))
                 continue
             run_testing_per_region(
-                model_name, [region], region, base_dir, all_testing_files, is_read_text, logger,
-                all_data)
+                model_name, [region], region, config, all_testing_files, read_mode, logger,
+                _get_shared_data(all_data, region))
     elif test_mode == "cross":
         for model_name in models:
             model_path = get_model_path(base_dir, model_name)
@@ -41,8 +46,8 @@ def run_testing(config, models, regions, is_read_text, test_mode, logger, all_da
                 continue
             for region in regions:
                 run_testing_per_region(
-                    model_name, [region], region, base_dir, all_testing_files, is_read_text, logger,
-                    all_data)
+                    model_name, [region], region, config, all_testing_files, read_mode, logger,
+                    _get_shared_data(all_data, region))
     else:  # test_mode == "all"
         for model_name in models:
             model_path = get_model_path(base_dir, model_name)
@@ -50,19 +55,22 @@ def run_testing(config, models, regions, is_read_text, test_mode, logger, all_da
                 logger.log("Model {} does not exist.".format(model_name))
                 continue
             run_testing_per_region(
-                model_name, regions, "all", base_dir, all_testing_files, is_read_text, logger,
-                all_data)
+                model_name, regions, "all", config, all_testing_files, read_mode, logger,
+                _get_shared_data(all_data, "all"))
 
 
 def run_testing_per_region(
-        model_region, test_regions, test_region_str, base_dir, all_testing_files, is_read_text,
+        model_region, test_regions, test_region_str, config, all_testing_files, read_mode,
         logger, data=None):
+    base_dir = config["base_dir"]
     logger.log("start constructing datasets")
     if data is None:
         (features, labels, weights) = \
-            get_region_data(base_dir, all_testing_files, test_regions, is_read_text,
-                    TEST_PREFIX, logger)
+            get_region_data(base_dir, all_testing_files, test_regions, read_mode,
+                    TEST_PREFIX, logger, config.get("load_workers", 1),
+                    config.get("max_inflight_files"), get_feature_columns(config))
     else:
+        logger.log("reuse the shared testing data of {}".format(test_region_str))
         (features, labels, weights) = data
     logger.log("finished loading testing data")
     if len(features) == 0:
@@ -70,21 +78,130 @@ def run_testing_per_region(
         return
     # Start testing
     model_path = get_model_path(base_dir, model_region)
-    scores = get_scores(model_region, test_region_str, features, labels, model_path, logger)
-    persist_predictions(base_dir, model_region, test_region_str, features, labels, scores, weights)
+    scores = get_scores(
+        model_region, test_region_str, features, labels, model_path, logger,
+        config.get("predict_batch_size", PREDICT_BATCH_SIZE), config.get("num_thread", 0),
+        weights, config.get("approximate_metrics", False),
+        config.get("inference_engine", "lightgbm"))
+    meta = get_test_meta(config, features, all_testing_files, test_regions, logger)
+    persist_predictions(base_dir, model_region, test_region_str, meta, labels, scores, weights)
     logger.log("finished testing")
+    logger.flush()
+
+
+def run_testing_matrix(config, models, regions, read_mode, name, logger, all_data=None):
+    """Evaluate every model on every test region, loading each model and each region once.
+
+    The (model, region) pairs are scored in a thread pool of ``config["eval_workers"]``
+    threads, which share the ``config["num_thread"]`` LightGBM threads.
+    The metrics of all pairs are written to a single table.
+    """
+    base_dir = config["base_dir"]
+    logger.log("start testing, matrix {}".format(name))
+    with open(config["testing_files"]) as f:
+        all_testing_files = f.readlines()
+
+    loaded_models = {}
+    for model_name in models:
+        model_path = get_model_path(base_dir, model_name)
+        if not os.path.exists(model_path):
+            logger.log("Model {} does not exist.".format(model_name))
+            continue
+        loaded_models[model_name] = load_model(
+            model_path, config.get("inference_engine", "lightgbm"))
+    datasets = {}
+    metas = {}
+    for region in regions:
+        data = _get_shared_data(all_data, region)
+        if data is None:
+            data = get_region_data(
+                base_dir, all_testing_files, [region], read_mode, TEST_PREFIX, logger,
+                config.get("load_workers", 1), config.get("max_inflight_files"),
+                get_feature_columns(config))
+        if len(data[0]) == 0:
+            logger.log("No data is loaded for {}.".format(region))
+            continue
+        datasets[region] = data
+        metas[region] = get_test_meta(config, data[0], all_testing_files, [region], logger)
+    logger.log("loaded {} models and {} test regions".format(len(loaded_models), len(datasets)))
+
+    # Largest test regions first, so that the small ones fill up the threads at the end
+    pairs = [(model_name, region)
+             for region in sorted(datasets, key=lambda t: -len(datasets[t][0]))
+             for model_name in loaded_models]
+    num_workers = max(1, min(len(pairs), config.get("eval_workers", 1)))
+    num_threads = max(1, config.get("num_thread", 1) // num_workers)
 
+    def evaluate(model_name, region):
+        features, labels, weights = datasets[region]
+        scores, metrics = score_model(
+            loaded_models[model_name], model_name, region, features, labels, logger, num_threads,
+            config.get("predict_batch_size", PREDICT_BATCH_SIZE), weights,
+            config.get("approximate_metrics", False))
+        persist_predictions(base_dir, model_name, region, metas[region], labels, scores, weights)
+        return (len(labels),) + metrics
 
-def get_all_data(base_dir, all_files, test_regions, is_read_text, logger):
-    return get_region_data(base_dir, all_files, test_regions, is_read_text, TEST_PREFIX, logger)
+    results = {}
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        futures = [(pair, pool.submit(evaluate, *pair)) for pair in pairs]
+        for pair, future in futures:
+            try:
+                results[pair] = future.result()
+            except Exception as err:
+                logger.log("Failed to test {} on {}, Error, {}".format(pair[0], pair[1], err))
+    persist_eval_matrix(base_dir, name, results)
+    logger.log("finished testing, matrix {}".format(name))
+    logger.flush()
+    return results
+
+
+def _get_shared_data(all_data, test_region_str):
+    # `all_data` maps the test regions to their data loaded in advance
+    if all_data is None:
+        return None
+    return all_data.get(test_region_str)
+
+
+def get_test_meta(config, features, all_files, test_regions, logger):
+    """Return the `META_COLUMNS` of the test rows of `features`, whatever the feature set.
+
+    They are taken from the features if the feature set has them, and read
+    from the test caches, which the features were loaded from, otherwise.
+    """
+    columns = get_feature_columns(config)
+    if all(column in columns for column in META_COLUMNS):
+        return features[:, get_column_positions(columns, META_COLUMNS)]
+    meta = get_region_data(config["base_dir"], all_files, test_regions, "pickle", TEST_PREFIX,
+                           logger, config.get("load_workers", 1),
+                           config.get("max_inflight_files"), META_COLUMNS)[0]
+    if len(meta) != len(features):
+        raise ValueError("the test caches have {} rows with the metadata columns, {} with the "
+                         "features".format(len(meta), len(features)))
+    return meta
+
+
+def get_all_data(config, all_files, test_regions, read_mode, logger):
+    return get_region_data(config["base_dir"], all_files, test_regions, read_mode, TEST_PREFIX,
+                           logger, config.get("load_workers", 1), config.get("max_inflight_files"),
+                           get_feature_columns(config))
 
 
 # Specify a data file
 def run_testing_specific_file(model_name, test_filenames, test_region_name, config, logger):
     logger.log("start loading datasets")
-    features, labels, weights = load_examples_from_pickle(test_filenames)
+    features, labels, weights = load_examples_from_pickle(
+        test_filenames, get_feature_columns(config))
     logger.log("finished loading testing data")
     model_path = get_model_path(config["base_dir"], model_name)
-    scores = get_scores(model_name, test_region_name, features, labels, model_path, logger)
+    scores = get_scores(
+        model_name, test_region_name, features, labels, model_path, logger,
+        config.get("predict_batch_size", PREDICT_BATCH_SIZE), config.get("num_thread", 0),
+        weights, config.get("approximate_metrics", False),
+        config.get("inference_engine", "lightgbm"))
+    columns = get_feature_columns(config)
+    if all(column in columns for column in META_COLUMNS):
+        meta = features[:, get_column_positions(columns, META_COLUMNS)]
+    else:
+        meta = load_examples_from_pickle(test_filenames, META_COLUMNS)[0]
     persist_predictions(
-        config["base_dir"], model_name, test_region_name, features, labels, scores, weights)
+        config["base_dir"], model_name, test_region_name, meta, labels, scores, weights)
@@ -0,0 +1,220 @@
+import argparse
+import json
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+from .cache import load_manifest
+from .file_weights import FileWeights
+from .load_data import BINARY_DIR
+from .load_data import CACHE_EXT
+from .load_data import DATASET_DTYPE
+from .load_data import DATASET_LABEL_DTYPE
+from .load_data import FEATURE_INDEX
+from .load_data import LEGACY_CACHE_EXT
+from .load_data import get_caches
+from .load_data import get_column_positions
+from .load_data import get_file_weight
+from .load_data import get_manifest_path
+from .load_data import get_provenance_path
+from .load_data import get_region_files
+from .load_data import get_sources
+from .load_data import read_data_from_binary
+from .provenance import save_provenance
+
+
+# The tiles are the cells of a `tile_degrees` lon/lat grid, numbered row by row
+# from (-180, -90). The index of a cache file lists the runs of consecutive rows
+# in the same tile, sorted by tile, in `{cache file}.tiles.npz`.
+TILE_DEGREES = 1.0
+TILE_INDEX_EXT = ".tiles.npz"
+LON_LAT_COLUMNS = [0, 1]
+
+
+def get_grid_shape(tile_degrees=TILE_DEGREES):
+    return (int(np.ceil(180.0 / tile_degrees)), int(np.ceil(360.0 / tile_degrees)))
+
+
+def get_tile_ids(lon, lat, tile_degrees=TILE_DEGREES):
+    """Return the tile of every (lon, lat), -1 if one of them is NaN."""
+    num_lat, num_lon = get_grid_shape(tile_degrees)
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    missing = np.isnan(lon) | np.isnan(lat)
+    lon_index = np.clip(np.floor((np.nan_to_num(lon) + 180.0) / tile_degrees), 0, num_lon - 1)
+    lat_index = np.clip(np.floor((np.nan_to_num(lat) + 90.0) / tile_degrees), 0, num_lat - 1)
+    tiles = lat_index.astype(np.int64) * num_lon + lon_index.astype(np.int64)
+    tiles[missing] = -1
+    return tiles
+
+
+def get_tiles_in_box(bbox, tile_degrees=TILE_DEGREES):
+    """Return the tiles that intersect `bbox` = (lon_min, lat_min, lon_max, lat_max).
+
+    A box with ``lon_min > lon_max`` crosses the antimeridian.
+    """
+    lon_min, lat_min, lon_max, lat_max = bbox
+    num_lat, num_lon = get_grid_shape(tile_degrees)
+    (first_lon, last_lon), (first_lat, last_lat) = [
+        np.clip(np.floor((np.array(bounds) + offset) / tile_degrees), 0, num - 1).astype(int)
+        for bounds, offset, num in [((lon_min, lon_max), 180.0, num_lon),
+                                    ((lat_min, lat_max), 90.0, num_lat)]]
+    if lon_min <= lon_max:
+        lon_indices = np.arange(first_lon, last_lon + 1)
+    else:
+        lon_indices = np.concatenate([np.arange(first_lon, num_lon), np.arange(0, last_lon + 1)])
+    lat_indices = np.arange(first_lat, last_lat + 1)
+    return (lat_indices[:, None] * num_lon + lon_indices[None, :]).reshape(-1)
+
+
+def in_box(lon, lat, bbox):
+    lon_min, lat_min, lon_max, lat_max = bbox
+    in_lon = (lon >= lon_min) & (lon <= lon_max) if lon_min <= lon_max else \
+        (lon >= lon_min) | (lon <= lon_max)
+    return in_lon & (lat >= lat_min) & (lat <= lat_max)
+
+
+def build_tile_runs(lon, lat, tile_degrees=TILE_DEGREES):
+    """Run-length encode the tiles of the rows, returns `(tiles, starts, counts)` sorted by tile."""
+    tiles = get_tile_ids(lon, lat, tile_degrees)
+    if len(tiles) == 0:
+        return (tiles, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+    starts = np.concatenate([[0], np.flatnonzero(tiles[1:] != tiles[:-1]) + 1])
+    counts = np.diff(np.concatenate([starts, [len(tiles)]]))
+    order = np.argsort(tiles[starts], kind='stable')
+    return (tiles[starts][order], starts[order], counts[order])
+
+
+def _get_cache_file(bin_filename):
+    if not os.path.exists(bin_filename) and bin_filename.endswith(CACHE_EXT):
+        return bin_filename[:-len(CACHE_EXT)] + LEGACY_CACHE_EXT
+    return bin_filename
+
+
+def build_tile_index(bin_filename, tile_degrees=TILE_DEGREES):
+    """Write the tile index of a cache file, reading only its lon and lat columns."""
+    lon_lat, _, _, _ = read_data_from_binary(bin_filename, LON_LAT_COLUMNS)
+    tiles, starts, counts = build_tile_runs(lon_lat[:, 0], lon_lat[:, 1], tile_degrees)
+    index = {"tile_degrees": tile_degrees, "rows": lon_lat.shape[0],
+             "tiles": tiles, "starts": starts, "counts": counts}
+    index_filename = bin_filename + TILE_INDEX_EXT
+    tmp_filename = index_filename + ".tmp"
+    with open(tmp_filename, 'wb') as f:
+        np.savez(f, **index)
+    os.replace(tmp_filename, index_filename)
+    return index
+
+
+def load_tile_index(bin_filename, tile_degrees=TILE_DEGREES):
+    """Load the tile index of a cache file, rebuild it if it is missing or older than the cache."""
+    index_filename = bin_filename + TILE_INDEX_EXT
+    if os.path.exists(index_filename) and \
+            os.path.getmtime(index_filename) >= os.path.getmtime(_get_cache_file(bin_filename)):
+        with np.load(index_filename) as data:
+            index = {key: data[key] for key in data.files}
+        if float(index["tile_degrees"]) == tile_degrees:
+            return index
+    return build_tile_index(bin_filename, tile_degrees)
+
+
+def select_runs(index, tiles):
+    """Return the rows of the index in `tiles`, in the order of the cache file."""
+    selected = np.isin(index["tiles"], tiles)
+    starts = index["starts"][selected]
+    counts = index["counts"][selected]
+    order = np.argsort(starts)
+    starts, counts = starts[order], counts[order]
+    offsets = np.cumsum(counts) - counts
+    return np.arange(int(np.sum(counts))) + np.repeat(starts - offsets, counts)
+
+
+def get_region_data_in_tiles(base_dir, files, regions, read_mode, prefix, logger, bbox=None,
+                             tiles=None, tile_degrees=TILE_DEGREES, num_workers=1,
+                             max_inflight=None, columns=None):
+    """Load the rows of the regions inside a bounding box or a list of tiles.
+
+    Same as `get_region_data`, except that only the runs of rows in the
+    selected tiles are read from the caches (the tiles of `bbox` and
+    `tiles`), and the rows of the tiles on the border of `bbox` are filtered
+    by their lon/lat. The tile indexes are built on the first use.
+    """
+    start_time = time()
+    if columns is None:
+        columns = FEATURE_INDEX
+    region_str = regions[0] if len(regions) == 1 else "all"
+    caches, manifest, num_parsed = get_caches(
+        base_dir, get_region_files(files, regions), read_mode, prefix, logger, num_workers,
+        max_inflight, columns)
+    selected_tiles = [] if tiles is None else list(tiles)
+    if bbox is not None:
+        selected_tiles += get_tiles_in_box(bbox, tile_degrees).tolist()
+
+    # First pass, find the selected rows of each cache file
+    selections = []
+    for filename, bin_filename, rows, cache_columns in caches:
+        selected = select_runs(load_tile_index(bin_filename, tile_degrees), selected_tiles)
+        if bbox is not None and len(selected) > 0:
+            lon_lat, _, _, _ = read_data_from_binary(bin_filename, LON_LAT_COLUMNS)
+            selected = selected[in_box(lon_lat[selected, 0], lon_lat[selected, 1], bbox)]
+        selections.append(selected)
+
+    # Second pass, copy the selected rows of each cache file into place
+    num_rows = sum(len(selected) for selected in selections)
+    data_features = np.empty((num_rows, len(columns)), dtype=DATASET_DTYPE)
+    data_labels   = np.empty(num_rows, dtype=DATASET_LABEL_DTYPE)
+    data_weights  = FileWeights([get_file_weight(cache[0]) for cache in caches],
+                                [len(selected) for selected in selections])
+    st = 0
+    for (filename, bin_filename, rows, cache_columns), selected in zip(caches, selections):
+        if len(selected) == 0:
+            continue
+        features, labels, _, _ = read_data_from_binary(bin_filename)
+        ed = st + len(selected)
+        for j, position in enumerate(get_column_positions(cache_columns, columns)):
+            data_features[st:ed, j] = features[selected, position]
+        data_labels[st:ed]   = labels[selected] > 0
+        logger.log("loaded, {}, selected, {}, size, {}, dim, {}".format(
+            filename, len(selected), rows, len(columns)))
+        st = ed
+
+    # The provenance of the selection does not replace the one of the whole region
+    name = "{}_tiles".format(region_str)
+    save_provenance(get_provenance_path(base_dir, prefix, name), get_sources(caches, manifest),
+                    [len(selected) for selected in selections])
+    logger.log("Dataset is loaded, size {}, from {} rows".format(
+        data_features.shape, sum(cache[2] for cache in caches)))
+    logger.record("load", prefix=prefix, region=name, read_mode=read_mode, files=len(caches),
+                  parsed_files=num_parsed, rows=num_rows, tiles=len(selected_tiles),
+                  seconds=time() - start_time)
+    return (data_features, data_labels, data_weights)
+
+
+def _build_tile_index(args):
+    bin_filename, tile_degrees = args
+    try:
+        index = build_tile_index(bin_filename, tile_degrees)
+        return (bin_filename, len(index["tiles"]), None)
+    except Exception as err:
+        return (bin_filename, None, err)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the tile indexes of the cache files")
+    parser.add_argument("config")
+    parser.add_argument("--prefixes", nargs="+", default=["train", "valid", "test"])
+    parser.add_argument("--tile-degrees", type=float, default=TILE_DEGREES)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    with open(args.config) as f:
+        config = json.load(f)
+    base_dir = os.path.expanduser(config["base_dir"])
+    tasks = [(os.path.join(base_dir, BINARY_DIR, cache_name), args.tile_degrees)
+             for prefix in args.prefixes
+             for cache_name in sorted(load_manifest(get_manifest_path(base_dir, prefix))["files"])]
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        for bin_filename, num_runs, err in pool.map(_build_tile_index, tasks):
+            if err is not None:
+                print("Failed to index {}, Error, {}".format(bin_filename, err))
+                continue
+            print("indexed, {}, runs, {}".format(bin_filename, num_runs))
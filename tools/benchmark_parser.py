@@ -0,0 +1,42 @@
+import sys
+import numpy as np
+from time import time
+
+from ..load_data import read_data_from_text
+from ..load_data import read_data_from_text_by_line
+
+
+def benchmark(filenames, repeat=3):
+    results = {}
+    for name, parser in [("line", read_data_from_text_by_line), ("bulk", read_data_from_text)]:
+        best = None
+        for _ in range(repeat):
+            num_rows = 0
+            start = time()
+            for filename in filenames:
+                features, _labels, _weights, _incorrect_cols = parser(filename)
+                num_rows += len(features)
+            duration = time() - start
+            best = duration if best is None else min(best, duration)
+        results[name] = (num_rows, best)
+        print("{}, rows, {}, seconds, {:.3f}, rows/sec, {:.0f}".format(
+            name, num_rows, best, num_rows / best))
+    print("speedup, {:.2f}x".format(results["line"][1] / results["bulk"][1]))
+    return results
+
+
+def check_parity(filename):
+    line_features, line_labels, _, line_incorrect = read_data_from_text_by_line(filename)
+    bulk_features, bulk_labels, _, bulk_incorrect = read_data_from_text(filename)
+    assert(line_incorrect == bulk_incorrect)
+    assert(np.array_equal(np.array(line_features), bulk_features, equal_nan=True))
+    assert(np.array_equal(np.array(line_labels, dtype=bool), bulk_labels))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m bathymetry.tools.benchmark_parser <tsv_file> [<tsv_file> ...]")
+        sys.exit(1)
+    for filename in sys.argv[1:]:
+        check_parity(filename)
+    benchmark(sys.argv[1:])
@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import lightgbm as lgb
+import numpy as np
+from time import time
+
+from ..booster import get_scores
+from ..booster import load_model
+from ..booster import train
+from ..common import Logger
+from ..common import get_peak_rss
+from ..file_weights import get_row_weights
+from ..load_data import get_datasets
+from ..load_data import get_model_path
+from ..load_data import init_setup
+from ..load_data import read_data_from_text
+from ..train import get_binning_params
+from .generate_synthetic import generate_dataset
+
+
+# Any region of `inst_weights`, which sets the example weights
+REGION = "SIO"
+CONFIG = {
+    "rounds": 20,
+    "objective": "binary",
+    "boosting_type": "gbdt",
+    "learning_rate": 0.1,
+    "tree_learner": "serial",
+    "num_thread": 0,
+    "min_data_in_leaf": 1,
+    "is_unbalance": True,
+    "num_leaves": 31,
+    "max_bin": 255,
+    "verbose": -1,
+    # The weights of a few synthetic rows sum up to less than the default
+    # `min_sum_hessian_in_leaf`, which would keep the trees from splitting
+    "min_sum_hessian_in_leaf": 0.0,
+}
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def timed(results, name, rows, func):
+    start = time()
+    value = func()
+    seconds = time() - start
+    results[name] = {
+        "seconds": seconds,
+        "rows": rows,
+        "rows_per_sec": rows / seconds if seconds > 0 else None,
+        "peak_rss": get_peak_rss(),
+    }
+    print("{}, rows, {}, seconds, {:.3f}, rows/sec, {:.0f}".format(
+        name, rows, seconds, results[name]["rows_per_sec"] or 0))
+    return value
+
+
+def check_model(model_path, rounds):
+    """Check that the benchmarked model has all its trees, and that they split."""
+    booster = load_model(model_path)
+    num_leaves = [tree["num_leaves"] for tree in booster.dump_model()["tree_info"]]
+    if booster.num_trees() != rounds or max(num_leaves, default=0) <= 1:
+        raise ValueError("the benchmarked model has {} trees of at most {} leaves, "
+                         "{} trees with splits are expected".format(
+                             booster.num_trees(), max(num_leaves, default=0), rounds))
+
+
+def run_benchmarks(work_dir, num_files, rows_per_file, rounds, seed=0):
+    """Time each stage of the pipeline on synthetic data written to `work_dir`."""
+    data_dir = os.path.join(work_dir, "data")
+    base_dir = os.path.join(work_dir, "workspace")
+    for dir_path in [data_dir, base_dir]:
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+    init_setup(base_dir)
+    logger = Logger()
+    logger.set_file_handle(os.path.join(work_dir, "benchmark.log"))
+    config = dict(CONFIG, base_dir=base_dir, rounds=rounds)
+    results = {}
+
+    num_rows = num_files * rows_per_file
+    timed(results, "generate", num_rows, lambda: generate_dataset(
+        data_dir, [REGION], num_files, rows_per_file, seed))
+    # Benchmark on all files, whichever split they are in
+    filenames = sorted(
+        os.path.join(data_dir, REGION, filename)
+        for filename in os.listdir(os.path.join(data_dir, REGION)))
+
+    timed(results, "read_data_from_text", num_rows,
+          lambda: [read_data_from_text(filename) for filename in filenames])
+    timed(results, "get_datasets_text", num_rows,
+          lambda: get_datasets(REGION, base_dir, filenames, "tsv", "bench", logger))
+    features, labels, weights = timed(
+        results, "get_datasets_binary", num_rows,
+        lambda: get_datasets(REGION, base_dir, filenames, "pickle", "bench", logger))
+    dataset = timed(results, "lgb_dataset", num_rows, lambda: lgb.Dataset(
+        features, label=labels, weight=get_row_weights(weights),
+        params=get_binning_params(config), free_raw_data=False).construct())
+    timed(results, "train", num_rows * rounds,
+          lambda: train(config, dataset, None, REGION, logger))
+    # The timings of a constant model would not mean anything
+    check_model(get_model_path(base_dir, REGION), rounds)
+    timed(results, "get_scores", num_rows, lambda: get_scores(
+        REGION, REGION, features, labels, get_model_path(base_dir, REGION), logger))
+    logger.flush()
+    return results
+
+
+def compare(results, previous):
+    for name, result in sorted(results.items()):
+        if name in previous and previous[name]["seconds"] > 0:
+            print("{}, seconds, {:.3f}, previous, {:.3f}, ratio, {:.2f}".format(
+                name, result["seconds"], previous[name]["seconds"],
+                result["seconds"] / previous[name]["seconds"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ingest, train and score pipeline on synthetic data")
+    parser.add_argument("work_dir")
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=250000, help="rows per file")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="default: <work_dir>/benchmark_results.json")
+    parser.add_argument("--compare", help="results file of a previous run")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.work_dir, args.files, args.rows, args.rounds, args.seed)
+    report = {
+        "time": time(),
+        "commit": get_git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "lightgbm": lgb.__version__,
+        "cpus": os.cpu_count(),
+        "params": {"files": args.files, "rows": args.rows, "rounds": args.rounds,
+                   "seed": args.seed},
+        "results": results,
+    }
+    output = args.output or os.path.join(args.work_dir, "benchmark_results.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print("results written to {}".format(output))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)["results"])
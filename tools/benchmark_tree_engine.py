@@ -0,0 +1,58 @@
+import argparse
+import sys
+import numpy as np
+from time import time
+
+from ..booster import load_model
+from ..load_data import CACHE_COLUMNS
+from ..load_data import FEATURE_INDEX
+from ..load_data import get_column_positions
+from ..load_data import read_data_from_binary
+from ..load_data import read_data_from_text
+from ..tree_engine import check_parity
+
+
+def load_features(filenames, columns=FEATURE_INDEX):
+    # Accept both the raw TSV files and the cache files of `runtime_data`
+    features = []
+    for filename in filenames:
+        if filename.endswith(".tsv"):
+            features.append(
+                read_data_from_text(filename)[0][:, get_column_positions(CACHE_COLUMNS, columns)])
+        else:
+            features.append(np.asarray(read_data_from_binary(filename, columns)[0]))
+    return np.concatenate(features)
+
+
+def benchmark(models, features, num_threads=0, repeat=3):
+    params = {"num_threads": num_threads} if num_threads > 0 else {}
+    for name, model in models:
+        best = None
+        for _ in range(repeat):
+            start = time()
+            model.predict(features, **params)
+            duration = time() - start
+            best = duration if best is None else min(best, duration)
+        print("{}, trees, {}, rows, {}, seconds, {:.3f}, rows/sec, {:.0f}".format(
+            name, model.num_trees(), len(features), best, len(features) / best))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the scores and the throughput of LightGBM and of the NumPy engine")
+    parser.add_argument("model", help="the .pkl model (the .txt model next to it is compiled)")
+    parser.add_argument("data_files", nargs="+", help="TSV or cache files")
+    parser.add_argument("--check", action="store_true",
+                        help="only check that the engines give the same scores")
+    args = parser.parse_args()
+    booster = load_model(args.model)
+    engine = load_model(args.model, "numpy")
+    features = load_features(args.data_files)
+    try:
+        max_diff = check_parity(booster, engine, features)
+    except ValueError as err:
+        print("parity, rows, {}, {}".format(len(features), err))
+        sys.exit(1)
+    print("parity, rows, {}, max abs diff, {:.3g}".format(len(features), max_diff))
+    if not args.check:
+        benchmark([("lightgbm", booster), ("numpy", engine)], features)
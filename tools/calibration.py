@@ -4,53 +4,109 @@ import os
 import pickle
 import sys
 
-from joblib import dump, load
+from joblib import Parallel, delayed, dump, load
+from sklearn.isotonic import IsotonicRegression
 from sklearn.linear_model import LogisticRegression
 
+from ..metrics import evaluate_scores
+from ..score_store import list_partitions
+from ..score_store import load_rows
+from ..score_store import load_scores
+
+
+# "logistic" fits the logistic regression on all scores, "platt" and "isotonic" fit
+# on a histogram of `NUM_BINS` bins of the scores, which scales to any number of scores
+METHODS = ["logistic", "platt", "isotonic"]
+NUM_BINS = 10000
+PREDICT_BATCH_SIZE = 10000000
+
 
 class Calibration:
     def __init__(self):
         parser = argparse.ArgumentParser(description="Calibrate the scores given by boosting trees")
-        parser.add_argument("task", help="select the task to perform, train or test")
+        parser.add_argument("task", help="select the task to perform, train, test or batch")
         args = parser.parse_args(sys.argv[1:2])
         getattr(self, args.task)()
 
     def train(self):
-        scores_file, model_file, result_file = get_args("train a calibration model", False)
-        scores, labels = parse_scores(scores_file)
-        lr = LogisticRegression()
-        lr.fit(scores, labels)
-        dump(lr, model_file)
+        args = get_args("train a calibration model", False)
+        scores, labels = read_scores(args)
+        dump(fit_calibrator(scores, labels, args.method, args.bins), args.model)
 
     def test(self):
-        scores_file, model_file, result_file = get_args(
-                "get the calibrated probability from the boosting scores", True, True)
-        scores, labels = parse_scores(scores_file)
-        lr = load(model_file)
-        proba = lr.predict_proba(scores)
-        with open(result_file, "wb") as f:
+        args = get_args("get the calibrated probability from the boosting scores", True, True)
+        scores, labels = read_scores(args)
+        calibrator = load(args.model)
+        proba = predict_calibrated(calibrator, scores)
+        metrics = evaluate_scores(labels, proba[:, 1])
+        print(", ".join("{}, {}".format(name, value) for name, value in sorted(metrics.items())))
+        with open(args.result, "wb") as f:
             pickle.dump((proba, scores, labels), f)
 
+    def batch(self):
+        parser = argparse.ArgumentParser(
+            description="train and test the calibration models of all scores in one process")
+        parser.add_argument("--base-dir", help="the base_dir of the score store")
+        parser.add_argument("--scores-dir", help="a directory of scores files of the older versions")
+        parser.add_argument("--out-dir", required=True,
+                            help="the directory to write the models and the calibrated scores")
+        parser.add_argument("--method", choices=METHODS, default="platt")
+        parser.add_argument("--bins", type=int, default=NUM_BINS)
+        parser.add_argument("--workers", type=int, default=1, help="calibrations run in parallel")
+        args = parser.parse_args(sys.argv[2:])
+        if (args.base_dir is None) == (args.scores_dir is None):
+            parser.error("exactly one of --base-dir and --scores-dir is required")
+        if not os.path.exists(args.out_dir):
+            os.makedirs(args.out_dir)
+        sources = list_score_sources(args.base_dir, args.scores_dir)
+        results = Parallel(n_jobs=args.workers)(
+            delayed(calibrate)(source, args.out_dir, args.method, args.bins)
+            for source in sources)
+        for (model_region, test_region, _), metrics in zip(sources, results):
+            print("{}, {}, {}".format(model_region, test_region, ", ".join(
+                "{}, {}".format(name, value) for name, value in sorted(metrics.items()))))
+
 
 def get_args(desc, model_req, result_req=False):
     parser = argparse.ArgumentParser(description=desc)
-    parser.add_argument("--scores", required=True, help="the file path to the scores file")
+    parser.add_argument("--scores", help="the file path to a scores file of the older versions")
+    parser.add_argument("--base-dir", help="the base_dir of the score store")
+    parser.add_argument("--model-region", help="the model of the scores in the score store")
+    parser.add_argument("--test-region", help="the test region of the scores in the score store")
     parser.add_argument("--model", required=True, help="the file path to the model file")
     parser.add_argument("--result", required=result_req, help="the file path to write the calibrated scores")
+    parser.add_argument("--method", choices=METHODS, default="logistic")
+    parser.add_argument("--bins", type=int, default=NUM_BINS, help="the histogram bins of platt and isotonic")
     args = parser.parse_args(sys.argv[2:])
-    scores_filepath = args.scores
-    models_filepath = args.model
-    result_filepath = args.result
-    for req, filepath in [(True, scores_filepath), (model_req, models_filepath)]:
+    if args.scores is None and None in [args.base_dir, args.model_region, args.test_region]:
+        parser.error("either --scores or --base-dir, --model-region and --test-region are required")
+    for req, filepath in [(args.scores is not None, args.scores), (model_req, args.model)]:
         if req and not os.path.exists(filepath):
             print("{} does not exist.".format(filepath))
             sys.exit(1)
-    return scores_filepath, models_filepath, result_filepath
+    return args
+
+
+def read_scores(args):
+    if args.scores is not None:
+        return parse_scores(args.scores)
+    base_dir = os.path.expanduser(args.base_dir)
+    _, labels, _ = load_rows(base_dir, args.test_region)
+    scores = load_scores(base_dir, args.model_region, args.test_region)
+    return get_calibration_examples(scores, labels)
 
 
 def parse_scores(filename):
+    return get_calibration_examples(*load_scores_file(filename))
+
+
+def load_scores_file(filename):
     with open(filename, "rb") as f:
         _, labels, scores, _ = pickle.load(f)
+    return (scores, labels)
+
+
+def get_calibration_examples(scores, labels):
     pos_scores = 1.0 - scores[labels == 0]
     neg_scores = 1.0 - scores[labels == 1]
     scores = np.concatenate([pos_scores, neg_scores]).reshape(-1, 1)
@@ -58,5 +114,90 @@ def parse_scores(filename):
     return (scores, labels)
 
 
+def fit_calibrator(scores, labels, method="logistic", num_bins=NUM_BINS):
+    """Fit the probability of label 1 from the (n, 1) `scores`.
+
+    "platt" and "isotonic" fit on the mean score, the positive and the total
+    count of each of `num_bins` bins of the scores over [0, 1], so their cost
+    does not depend on the number of scores after one pass to count them.
+    """
+    scores = np.asarray(scores).reshape(-1)
+    if method == "logistic":
+        lr = LogisticRegression()
+        lr.fit(scores.reshape(-1, 1), labels)
+        return lr
+    bins = np.clip((scores * num_bins).astype(np.int64), 0, num_bins - 1)
+    totals = np.bincount(bins, minlength=num_bins).astype(np.float64)
+    positives = np.bincount(bins, weights=labels, minlength=num_bins)
+    sums = np.bincount(bins, weights=scores, minlength=num_bins)
+    nonempty = totals > 0
+    centers = sums[nonempty] / totals[nonempty]
+    totals = totals[nonempty]
+    positives = positives[nonempty]
+    if method == "isotonic":
+        ir = IsotonicRegression(y_min=0.0, y_max=1.0, out_of_bounds="clip")
+        ir.fit(centers, positives / totals, sample_weight=totals)
+        return ir
+    # Each bin is a positive and a negative example at its mean score, weighted by their counts
+    lr = LogisticRegression()
+    lr.fit(np.concatenate([centers, centers]).reshape(-1, 1),
+           np.concatenate([np.ones_like(centers), np.zeros_like(centers)]),
+           sample_weight=np.concatenate([positives, totals - positives]))
+    return lr
+
+
+def predict_calibrated(calibrator, scores, batch_size=PREDICT_BATCH_SIZE):
+    """Return the (n, 2) calibrated probabilities of the labels 0 and 1, in batches."""
+    scores = np.asarray(scores).reshape(-1)
+    proba = np.empty((scores.shape[0], 2))
+    for start in range(0, scores.shape[0], batch_size):
+        batch = scores[start:start + batch_size]
+        if isinstance(calibrator, IsotonicRegression):
+            proba[start:start + batch_size, 1] = calibrator.predict(batch)
+        else:
+            proba[start:start + batch_size, 1] = calibrator.predict_proba(batch.reshape(-1, 1))[:, 1]
+    proba[:, 0] = 1.0 - proba[:, 1]
+    return proba
+
+
+def list_score_sources(base_dir=None, scores_dir=None):
+    """List `(model_region, test_region, source)` of the score store or of a scores directory."""
+    if base_dir is not None:
+        base_dir = os.path.expanduser(base_dir)
+        return [(model_region, test_region, base_dir)
+                for test_region, models in list_partitions(base_dir).items()
+                for model_region in models]
+    sources = []
+    for filename in sorted(os.listdir(scores_dir)):
+        if filename.startswith("model_") and filename.endswith("_scores.pkl"):
+            model_region, test_region = filename[len("model_"):-len("_scores.pkl")].split("_test_")
+            sources.append((model_region, test_region, os.path.join(scores_dir, filename)))
+    return sources
+
+
+def calibrate(source, out_dir, method="platt", num_bins=NUM_BINS):
+    """Train and test the calibration of one pair of regions, reading its scores once.
+
+    The calibration model and the calibrated scores are written as in the
+    train and test tasks, but the examples keep the order of the scores.
+    """
+    model_region, test_region, path = source
+    if os.path.isdir(path):
+        scores = load_scores(path, model_region, test_region)
+        _, labels, _ = load_rows(path, test_region)
+    else:
+        scores, labels = load_scores_file(path)
+    # Calibrate the probability of label 0, as `get_calibration_examples` does
+    scores = (1.0 - np.asarray(scores, dtype=np.float64)).reshape(-1, 1)
+    labels = 1 - np.asarray(labels)
+    calibrator = fit_calibrator(scores, labels, method, num_bins)
+    proba = predict_calibrated(calibrator, scores)
+    base = os.path.join(out_dir, "model_{}_test_{}_scores".format(model_region, test_region))
+    dump(calibrator, base + ".cali.joblib")
+    with open(base + ".proba.pkl", "wb") as f:
+        pickle.dump((proba, scores, labels), f, protocol=4)
+    return evaluate_scores(labels, proba[:, 1])
+
+
 if __name__ == "__main__":
     Calibration()
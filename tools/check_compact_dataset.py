@@ -0,0 +1,107 @@
+import argparse
+import os
+import sys
+import lightgbm as lgb
+import numpy as np
+
+from ..booster import score_model
+from ..common import Logger
+from ..file_weights import get_row_weights
+from ..load_data import FEATURE_INDEX
+from ..load_data import get_binary_filename
+from ..load_data import get_datasets
+from ..load_data import get_file_weight
+from ..load_data import init_setup
+from ..load_data import read_data_from_binary
+from ..metrics import METRIC_NAMES
+from ..train import get_binning_params
+from .benchmark_suite import CONFIG
+from .generate_synthetic import generate_dataset
+
+
+# Regions of `inst_weights`, so that the rows have different weights
+REGIONS = ["AGSO", "SIO"]
+MAX_METRIC_DIFF = 1e-3
+
+
+def load_wide_dataset(base_dir, filenames, prefix):
+    """Load the caches as the older versions did, float64 features and one weight per row."""
+    examples = [read_data_from_binary(get_binary_filename(base_dir, prefix, filename),
+                                      FEATURE_INDEX)[:2] for filename in filenames]
+    features = np.concatenate([np.asarray(t[0], dtype=np.float64) for t in examples])
+    labels = np.concatenate([t[1] > 0 for t in examples]).astype(np.int8)
+    weights = np.concatenate([np.full(t[1].shape[0], get_file_weight(filename))
+                              for filename, t in zip(filenames, examples)])
+    return (features, labels, weights)
+
+
+def get_dataset_bytes(features, labels, weights):
+    return features.nbytes + labels.nbytes + weights.nbytes
+
+
+def train_and_score(config, train_data, test_data, name, logger):
+    features, labels, weights = train_data
+    dataset = lgb.Dataset(features, label=labels, weight=get_row_weights(weights),
+                          params=get_binning_params(config))
+    params = {key: value for key, value in config.items() if key != "rounds"}
+    model = lgb.train(params, dataset, num_boost_round=config["rounds"])
+    features, labels, weights = test_data
+    _, metrics = score_model(model, name, name, features, labels, logger, weights=weights)
+    return dict(zip(METRIC_NAMES, metrics[1:]))
+
+
+def run_check(work_dir, num_files, rows_per_file, rounds, seed=0):
+    """Train the same model on the float64 and on the compact datasets, and compare them."""
+    data_dir = os.path.join(work_dir, "data")
+    base_dir = os.path.join(work_dir, "workspace")
+    for dir_path in [data_dir, base_dir]:
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+    init_setup(base_dir)
+    logger = Logger()
+    logger.set_file_handle(os.path.join(work_dir, "check_compact_dataset.log"))
+    # Deterministic training, so that only the dataset representation differs
+    config = dict(CONFIG, rounds=rounds, num_thread=1, deterministic=True, seed=seed)
+
+    lists = generate_dataset(data_dir, REGIONS, num_files, rows_per_file, seed)
+    files = {}
+    for split in ["training", "testing"]:
+        with open(lists[split]) as f:
+            files[split] = [filename.strip() for filename in f]
+
+    data = {}
+    for split, prefix in [("training", "train"), ("testing", "test")]:
+        data[("compact", split)] = get_datasets(
+            "all", base_dir, files[split], "auto", prefix, logger)
+        data[("wide", split)] = load_wide_dataset(base_dir, files[split], prefix)
+
+    results = {}
+    for name in ["wide", "compact"]:
+        results[name] = train_and_score(
+            config, data[(name, "training")], data[(name, "testing")], name, logger)
+        print("{}, dataset bytes, {}, {}".format(
+            name, get_dataset_bytes(*data[(name, "training")]), ", ".join(
+                "{}, {:.6f}".format(metric, results[name][metric]) for metric in METRIC_NAMES)))
+    max_diff = max(abs(results["wide"][metric] - results["compact"][metric])
+                   for metric in METRIC_NAMES)
+    print("max metric difference, {:.2e}, bytes ratio, {:.3f}".format(
+        max_diff, get_dataset_bytes(*data[("compact", "training")]) /
+        get_dataset_bytes(*data[("wide", "training")])))
+    logger.flush()
+    return max_diff
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that the compact datasets (float32 features, per-file weights) "
+                    "train models of the same quality as the float64 datasets")
+    parser.add_argument("work_dir")
+    parser.add_argument("--files", type=int, default=3, help="files per region")
+    parser.add_argument("--rows", type=int, default=100000, help="rows per file")
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    max_diff = run_check(args.work_dir, args.files, args.rows, args.rounds, args.seed)
+    if max_diff > MAX_METRIC_DIFF:
+        print("The metrics differ by more than {}".format(MAX_METRIC_DIFF))
+        sys.exit(1)
@@ -0,0 +1,83 @@
+import argparse
+import os
+import sys
+import numpy as np
+
+from ..common import Logger
+from ..load_data import META_COLUMNS
+from ..load_data import get_region_data
+from ..load_data import init_setup
+from ..score_store import list_partitions
+from ..score_store import load_rows
+from ..score_store import load_scores
+from ..test import TEST_PREFIX
+from ..test import run_testing
+from ..train import run_training
+from .benchmark_suite import CONFIG
+from .generate_synthetic import generate_dataset
+
+
+# The models are trained with different feature sets, and tested on the same region
+MODELS = [("AGSO", "default"), ("SIO", "all")]
+TEST_REGION = "SIO"
+
+
+def run_check(work_dir, rows_per_file, rounds, seed=0):
+    """Score one test region with models of two feature sets, and check the store keeps both.
+
+    Returns the list of the problems found, empty if the check passes.
+    """
+    data_dir = os.path.join(work_dir, "data")
+    base_dir = os.path.join(work_dir, "workspace")
+    for dir_path in [data_dir, base_dir]:
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+    init_setup(base_dir)
+    logger = Logger()
+    logger.set_file_handle(os.path.join(work_dir, "check_score_store.log"))
+    lists = generate_dataset(data_dir, [region for region, _ in MODELS], 3, rows_per_file, seed)
+    config = dict(CONFIG, base_dir=base_dir, training_files=lists["training"],
+                  validation_files=lists["validation"], testing_files=lists["testing"],
+                  rounds=rounds)
+
+    problems = []
+    scores = {}
+    for region, feature_set in MODELS:
+        model_config = dict(config, feature_set=feature_set)
+        run_training(model_config, [region], "auto", logger)
+        run_testing(model_config, [region], [TEST_REGION], "auto", "cross", logger)
+        scores[region] = np.array(load_scores(base_dir, region, TEST_REGION))
+        print("{}, feature set, {}, models in the store, {}".format(
+            region, feature_set, ", ".join(list_partitions(base_dir).get(TEST_REGION, []))))
+    for region, _ in MODELS:
+        try:
+            if not np.array_equal(np.asarray(load_scores(base_dir, region, TEST_REGION)),
+                                  scores[region]):
+                problems.append("the scores of {} changed".format(region))
+        except (KeyError, OSError) as err:
+            problems.append("the scores of {} are lost, {}".format(region, err))
+
+    with open(lists["testing"]) as f:
+        meta = get_region_data(base_dir, f.readlines(), [TEST_REGION], "pickle", TEST_PREFIX,
+                               logger, columns=META_COLUMNS)[0]
+    if not np.array_equal(np.asarray(load_rows(base_dir, TEST_REGION)[0]), meta, equal_nan=True):
+        problems.append("the metadata of the store are not the columns {}".format(META_COLUMNS))
+    logger.flush()
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that the score store keeps the scores of models trained with "
+                    "different feature sets on the same test region")
+    parser.add_argument("work_dir")
+    parser.add_argument("--rows", type=int, default=5000, help="rows per file")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    problems = run_check(args.work_dir, args.rows, args.rounds, args.seed)
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(1)
+    print("The scores of all models are kept")
@@ -0,0 +1,122 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from ..load_data import CACHE_EXT
+from ..load_data import TEXT_BLOCK_SIZE
+from ..load_data import parse_text_block
+from ..load_data import write_data_to_binary
+
+
+CHUNK_SIZE = 100000
+TSV_EXT = ".tsv"
+
+
+def count_lines(path, block_size=TEXT_BLOCK_SIZE):
+    num_lines = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            num_lines += block.count(b'\n')
+            last = block[-1:]
+    # The last line may not end with a line break
+    return num_lines + (last != b'\n')
+
+
+def get_chunk_bounds(num_lines, chunk_size=CHUNK_SIZE):
+    """Split `num_lines` lines into chunks of `chunk_size` lines.
+
+    A last chunk of less than half of `chunk_size` lines is merged into the
+    chunk before it.
+    """
+    bounds = []
+    cursor = 0
+    while cursor < num_lines:
+        start, end = cursor, cursor + chunk_size
+        if (num_lines - end) * 2 < chunk_size:
+            end = num_lines
+        cursor = end
+        bounds.append((start, end))
+    return bounds
+
+
+def write_chunk(lines, part_path, write_tsv, write_cache):
+    block = b"".join(lines)
+    if write_tsv:
+        with open(part_path, 'wb') as f:
+            f.write(block)
+    incorrect_cols = 0
+    if write_cache:
+        features, labels, incorrect_cols = parse_text_block(block)
+        write_data_to_binary(features, labels, part_path + CACHE_EXT)
+    return incorrect_cols
+
+
+def chunk_file(path, out_dir, chunk_size=CHUNK_SIZE, write_tsv=True, write_cache=False):
+    """Split a TSV file into `{basename}.part{i}.tsv` files in `out_dir`, streaming its lines.
+
+    The file is read twice, once to count its lines and once to write the
+    chunks, and at most one chunk is held in memory. With `write_cache`, each
+    chunk is also parsed and written to a `.tsv.col` cache file next to it,
+    which can be listed instead of the `.tsv` file in the file lists.
+
+    Returns
+    -------
+    parts : list
+        ``(part_path, rows, incorrect_cols)`` of each chunk.
+    """
+    basename = os.path.basename(path)[:-len(TSV_EXT)]
+    bounds = get_chunk_bounds(count_lines(path), chunk_size)
+    parts = []
+    with open(path, 'rb') as f:
+        for part, (start, end) in enumerate(bounds):
+            lines = [f.readline() for _ in range(end - start)]
+            part_path = os.path.join(out_dir, basename + ".part{}{}".format(part, TSV_EXT))
+            incorrect_cols = write_chunk(lines, part_path, write_tsv, write_cache)
+            parts.append((part_path, end - start, incorrect_cols))
+    return parts
+
+
+def _chunk_file(args):
+    path, out_dir, chunk_size, write_tsv, write_cache = args
+    try:
+        return (path, chunk_file(path, out_dir, chunk_size, write_tsv, write_cache), None)
+    except Exception as err:
+        return (path, None, err)
+
+
+def chunk_all(data_dir, write_dir, regions, num_workers=1, chunk_size=CHUNK_SIZE,
+              write_tsv=True, write_cache=False):
+    """Chunk the TSV files of `data_dir/{region}` into `write_dir/{region}`, one file per worker."""
+    tasks = []
+    for region in regions:
+        out_dir = os.path.join(write_dir, region)
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        dirname = os.path.join(data_dir, region)
+        for filename in sorted(os.listdir(dirname)):
+            if filename.endswith(TSV_EXT):
+                tasks.append(
+                    (os.path.join(dirname, filename), out_dir, chunk_size, write_tsv, write_cache))
+    with ProcessPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        for path, parts, err in pool.map(_chunk_file, tasks):
+            if err is not None:
+                print("Failed to chunk {}, Error, {}".format(path, err))
+                continue
+            print("chunked, {}, parts, {}, rows, {}, incorrect cols, {}".format(
+                path, len(parts), sum(part[1] for part in parts),
+                sum(part[2] for part in parts)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split the TSV data files into chunks")
+    parser.add_argument("data_dir")
+    parser.add_argument("write_dir")
+    parser.add_argument("--regions", nargs="+", required=True)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--format", choices=["tsv", "col", "both"], default="tsv",
+                        help="write the chunks as TSV files, as cache files, or both")
+    args = parser.parse_args()
+    chunk_all(args.data_dir, args.write_dir, args.regions, args.workers, args.chunk_size,
+              args.format in ["tsv", "both"], args.format in ["col", "both"])
@@ -0,0 +1,18 @@
+import json
+import os
+import sys
+
+from ..common import Logger
+from ..load_data import convert_pickle_caches
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [2, 3]:
+        print("Usage: python -m bathymetry.tools.convert_cache <config_path> [--remove]")
+        sys.exit(1)
+    with open(sys.argv[1]) as f:
+        config = json.load(f)
+    config["base_dir"] = os.path.expanduser(config["base_dir"])
+    logger = Logger()
+    logger.set_file_handle(os.path.join(config["base_dir"], "convert-cache.log"))
+    convert_pickle_caches(config["base_dir"], logger, remove=(sys.argv[2:] == ["--remove"]))
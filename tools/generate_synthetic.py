@@ -0,0 +1,105 @@
+import argparse
+import os
+import numpy as np
+
+from ..load_data import CORRUPT_SIGD
+from ..load_data import NUM_COLS
+from ..load_data import inst_weights
+
+
+KINDS = np.array(["M", "G", "S", "P", "X"])
+# Columns 09-33 of the schema in the README, they are all floats
+NUM_FLOAT_FEATURES = 25
+FORMAT = "\t".join(
+    ["%.5f", "%.5f", "%d", "%d", "%s", "%d", "%d", "%d", "%.9g"] +
+    ["%.9g"] * NUM_FLOAT_FEATURES + ["%d", "%s"])
+
+
+def generate_rows(num_rows, rng, corrupt_rate=0.3, short_rate=0.001, missing_rate=0.01):
+    """Generate `num_rows` lines of synthetic data in the 36-column schema of the README.
+
+    About `corrupt_rate` of the rows have `sigd == 9999`, and they tend to
+    have a larger relative difference between the depth and the predicted
+    depth, so that a model has something to learn. About `short_rate` of
+    the rows miss the last two columns (year and kind), and about
+    `missing_rate` of the float features are "nan".
+    """
+    depth = -rng.integers(1, 11000, size=num_rows)
+    corrupt = rng.random(num_rows) < corrupt_rate
+    noise = np.where(corrupt, 0.2, 0.02) * rng.standard_normal(num_rows)
+    pred = np.round(depth * (1.0 + noise)).astype(int)
+    features = rng.random((num_rows, NUM_FLOAT_FEATURES))
+    features[rng.random(features.shape) < missing_rate] = np.nan
+    sigd = np.where(corrupt, CORRUPT_SIGD, rng.choice(["-1", "0"], size=num_rows))
+    columns = [
+        rng.uniform(-180.0, 180.0, size=num_rows),
+        rng.uniform(-90.0, 90.0, size=num_rows),
+        depth,
+        np.zeros(num_rows, dtype=int),
+        sigd,
+        rng.integers(1, 20000, size=num_rows),
+        pred,
+        np.ones(num_rows, dtype=int),
+        (pred - depth) / depth,
+    ] + [features[:, j] for j in range(NUM_FLOAT_FEATURES)] + [
+        rng.integers(1960, 2020, size=num_rows),
+        KINDS[rng.integers(0, len(KINDS), size=num_rows)],
+    ]
+    short = rng.random(num_rows) < short_rate
+    lines = []
+    for i, row in enumerate(zip(*columns)):
+        line = FORMAT % row
+        if short[i]:
+            line = line.rsplit("\t", 2)[0]
+        lines.append(line)
+    return lines
+
+
+def write_synthetic_file(filename, num_rows, seed=0, **kwargs):
+    rng = np.random.default_rng(seed)
+    with open(filename, 'w') as f:
+        f.write("\n".join(generate_rows(num_rows, rng, **kwargs)) + "\n")
+
+
+def generate_dataset(out_dir, regions, files_per_region, rows_per_file, seed=0):
+    """Write `{out_dir}/{region}/{region}-partNNN.tsv` files and a file list for each split.
+
+    The files of each region are split between training, validation and
+    testing (in this order, at least one training file per region).
+
+    Returns
+    -------
+    lists : dict
+        Maps "training", "validation" and "testing" to the path of their file list.
+    """
+    splits = {"training": [], "validation": [], "testing": []}
+    for region_index, region in enumerate(regions):
+        dir_path = os.path.join(out_dir, region)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        for i in range(files_per_region):
+            filename = os.path.join(dir_path, "{}-part{:03d}.tsv".format(region, i))
+            write_synthetic_file(filename, rows_per_file, seed + region_index * 1000 + i)
+            split = ["training", "validation", "testing"][i % 3] if files_per_region > 1 \
+                else "training"
+            splits[split].append(filename)
+    lists = {}
+    for split, filenames in splits.items():
+        lists[split] = os.path.join(out_dir, "{}-filelist.txt".format(split))
+        with open(lists[split], 'w') as f:
+            f.write("".join(filename + "\n" for filename in filenames))
+    return lists
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write synthetic TSV files with {} columns".format(NUM_COLS))
+    parser.add_argument("out_dir")
+    parser.add_argument("--regions", nargs="+", default=sorted(inst_weights.keys())[:3])
+    parser.add_argument("--files", type=int, default=3, help="files per region")
+    parser.add_argument("--rows", type=int, default=100000, help="rows per file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    lists = generate_dataset(args.out_dir, args.regions, args.files, args.rows, args.seed)
+    for split, filename in sorted(lists.items()):
+        print("{}, {}".format(split, filename))
@@ -1,14 +1,4 @@
-dirname=/Users/igpp-jalafate/workbox/bathymetry-analysis/logs/by-cruises/cross-regions/runtime_scores
-files=$(ls $dirname)
-
-for filename in $(ls $dirname)
-do
-    base=${filename%.*}
-    model_name=$base.cali.joblib
-    proba_name=$base.proba.pkl
-    printf '.'
-    python calibration.py train --scores $dirname/$filename --model $model_name --result $proba_name
-    python calibration.py test --scores $dirname/$filename --model $model_name --result $proba_name
-done
-echo
+base_dir=/Users/igpp-jalafate/workbox/bathymetry-analysis/logs/by-cruises/cross-regions
+# Run from the parent directory of the bathymetry package
 
+python -m bathymetry.tools.calibration batch --base-dir $base_dir --out-dir . --method platt --workers 4
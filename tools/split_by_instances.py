@@ -1,74 +1,225 @@
+import argparse
 import json
 import numpy as np
 import os
-import pickle
-import sys
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 
+from ..cache import open_columnar
+from ..cache import write_columnar_blocks
 from ..common import Logger
-from ..load_data import get_region_data
+from ..file_weights import FileWeights
+from ..load_data import CACHE_COLUMNS
+from ..load_data import CACHE_EXT
+from ..load_data import DATASET_DTYPE
+from ..load_data import DATASET_LABEL_DTYPE
+from ..load_data import FEATURE_INDEX
+from ..load_data import LEGACY_CACHE_EXT
+from ..load_data import get_binary_filename
+from ..load_data import get_cache_columns
+from ..load_data import get_column_positions
+from ..load_data import get_feature_columns
+from ..load_data import get_region_files
+from ..load_data import inst_weights
+from ..load_data import read_data_from_binary
 
 TEST_PREFIX = "test"
 TRAIN_PREFIX = "train"
+INSTANCES_DIR = "data_pkl"
+SPLITS = ["training", "testing"]
+TRAIN_FRACTION = 0.8
+SHARD_ROWS = 5000000
 
 
 regions = ['AGSO', 'JAMSTEC', 'NGA', 'NGDC', 'NOAA_geodas', 'SIO', 'US_multi']
 
 
-def get_all_data(base_dir, all_files, region, logger):
-    is_read_text = False
-    (features1, labels1, weights1) = get_region_data(base_dir, all_files, [region], is_read_text,
-            TRAIN_PREFIX, logger)
-    (features2, labels2, weights2) = get_region_data(base_dir, all_files, [region], is_read_text,
-            TEST_PREFIX, logger)
-    features = np.concatenate([features1, features2], axis=0)
-    labels = np.concatenate([labels1, labels2], axis=0)
-    weights = np.concatenate([weights1, weights2], axis=0)
-    return (features, labels, weights)
-
-
-def shuffle_and_save(features, labels, weights, region):
-    assert(type(region) is str)
-    order = np.arange(features.shape[0], dtype=int)
-    np.random.shuffle(order)
-    k = int(features.shape[0] * 0.8)
-    with open("training-instances_{}.pkl".format(region), 'wb') as f:
-        pickle.dump((features[order[:k]], labels[order[:k]], weights[order[:k]]), f, protocol=4)
-    with open("testing-instances_{}.pkl".format(region), 'wb') as f:
-        pickle.dump((features[order[k:]], labels[order[k:]], weights[order[k:]]), f, protocol=4)
-
-
-def load_examples_from_pickle(pickle_files):
-    features = []
-    labels = []
-    weights = []
+def get_instances_manifest_path(base_dir, region):
+    return os.path.join(base_dir, INSTANCES_DIR, "instances_{}.json".format(region))
+
+
+def get_shard_path(base_dir, split, region, shard):
+    return os.path.join(
+        base_dir, INSTANCES_DIR, "{}-instances_{}.{:03d}.col".format(split, region, shard))
+
+
+def get_instance_files(base_dir, region, split):
+    """List the shards of the `split` ("training" or "testing") of a region.
+
+    Falls back to the single pickle file written by the older versions.
+    """
+    manifest_path = get_instances_manifest_path(base_dir, region)
+    if not os.path.exists(manifest_path):
+        return [os.path.join(base_dir, INSTANCES_DIR, "{}-instances_{}.pkl".format(split, region))]
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    return [os.path.join(base_dir, INSTANCES_DIR, shard["file"]) for shard in manifest[split]]
+
+
+def get_region_caches(base_dir, all_files, region):
+    # The examples of a region are in the caches of its training and test files
+    caches = []
+    for prefix in [TRAIN_PREFIX, TEST_PREFIX]:
+        for filename in get_region_files(all_files, [region]):
+            bin_filename = get_binary_filename(base_dir, prefix, filename.strip())
+            legacy_filename = bin_filename[:-len(CACHE_EXT)] + LEGACY_CACHE_EXT
+            if os.path.exists(bin_filename) or os.path.exists(legacy_filename):
+                caches.append(bin_filename)
+    return caches
+
+
+def assign_rows(bin_filename, num_rows, seed=0, train_fraction=TRAIN_FRACTION):
+    """Return a mask of the rows of a cache file that go to the training split.
+
+    The random generator is seeded with `seed` and the name of the file, so the
+    assignment does not depend on the order in which the files are processed.
+    """
+    rng = np.random.default_rng([seed, zlib.crc32(os.path.basename(bin_filename).encode())])
+    return rng.random(num_rows) < train_fraction
+
+
+def split_region(base_dir, all_files, region, seed=0, train_fraction=TRAIN_FRACTION,
+                 shard_rows=SHARD_ROWS, columns=None):
+    """Split the cached examples of a region into training and testing shards, out of core.
+
+    The cache files are memory-mapped and streamed into `.col` shards of about
+    `shard_rows` rows, one column at a time, so the memory does not depend on
+    the size of the region. The shards are listed in `instances_{region}.json`,
+    and have only `columns` (by default, the columns that all cache files of
+    the region have), as float32, so that they are loaded without a copy.
+    """
+    dir_path = os.path.join(base_dir, INSTANCES_DIR)
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+    weight = 1.0 / inst_weights[region]
+    shards = {split: [] for split in SPLITS}
+    pending = {split: [] for split in SPLITS}
+    pending_rows = {split: 0 for split in SPLITS}
+
+    caches = get_region_caches(base_dir, all_files, region)
+    cache_columns = [get_cache_columns(bin_filename)[1] for bin_filename in caches]
+    if columns is None:
+        columns = [column for column in CACHE_COLUMNS
+                   if all(column in other_columns for other_columns in cache_columns)]
+    # The positions of the columns in each cache file, the features are read unprojected
+    positions = [get_column_positions(other_columns, columns) for other_columns in cache_columns]
+    pending_positions = {split: [] for split in SPLITS}
+
+    def write_shard(split):
+        if not pending[split]:
+            return
+        path = get_shard_path(base_dir, split, region, len(shards[split]))
+        write_columnar_blocks(path, pending[split], columns, DATASET_DTYPE,
+                              pending_positions[split])
+        shards[split].append({"file": os.path.basename(path), "rows": pending_rows[split]})
+        pending[split] = []
+        pending_positions[split] = []
+        pending_rows[split] = 0
+
+    for bin_filename, cache_positions in zip(caches, positions):
+        features, labels, _, _ = read_data_from_binary(bin_filename)
+        is_train = assign_rows(bin_filename, labels.shape[0], seed, train_fraction)
+        weights = np.broadcast_to(weight, labels.shape[0])
+        for split, selected in zip(SPLITS, [is_train, ~is_train]):
+            pending[split].append((features, labels, weights, selected))
+            pending_positions[split].append(cache_positions)
+            pending_rows[split] += int(np.sum(selected))
+            if pending_rows[split] >= shard_rows:
+                write_shard(split)
+    for split in SPLITS:
+        write_shard(split)
+
+    manifest = {"region": region, "seed": seed, "train_fraction": train_fraction,
+                "columns": [int(column) for column in columns]}
+    manifest.update(shards)
+    with open(get_instances_manifest_path(base_dir, region), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def load_examples_from_pickle(pickle_files, columns=None):
+    """Load the examples of the instance shards (or of any cache or pickle files).
+
+    A single `.col` file with float32 features and `columns` (or any columns
+    if None) as a contiguous run of its columns, e.g. a shard written with
+    the same feature set, is returned memory-mapped, without reading it.
+    Otherwise the files are streamed, one column of one file at a time, into
+    a float32 cache next to the first file, which is returned memory-mapped.
+    The cache is removed once it is open, its space is freed with the arrays.
+    The weights are returned as a `FileWeights`.
+    """
+    if len(pickle_files) == 0:
+        return (np.empty((0, len(columns or FEATURE_INDEX)), dtype=DATASET_DTYPE),
+                np.empty(0, dtype=DATASET_LABEL_DTYPE), FileWeights())
+    if len(pickle_files) == 1:
+        features, labels, weights = read_data_from_binary(pickle_files[0], columns)[:3]
+        if features.dtype == DATASET_DTYPE and labels.dtype == DATASET_LABEL_DTYPE:
+            return (features, labels, FileWeights.from_rows(weights))
+    # The features of the files are read unprojected, only the `columns` are copied
+    if columns is None:
+        columns = get_cache_columns(pickle_files[0])[1]
+    blocks = []
+    positions = []
+    file_weights = []
     for filename in pickle_files:
-        with open(filename, "rb") as f:
-            _1, _2, _3 = pickle.load(f)
-            features.append(_1)
-            labels.append(_2)
-            weights.append(_3)
-    return (
-        np.concatenate(features, axis=0),
-        np.concatenate(labels, axis=0),
-        np.concatenate(weights, axis=0),
-    )
-
-
-def create_instance_based_splitting(config, regions, logger):
+        features, labels, weights = read_data_from_binary(filename)[:3]
+        blocks.append((features, labels, None, None))
+        positions.append(get_column_positions(get_cache_columns(filename)[1], columns))
+        file_weights.append(FileWeights.from_rows(weights))
+    handle, combined_path = tempfile.mkstemp(
+        prefix="combined-", suffix=CACHE_EXT, dir=os.path.dirname(pickle_files[0]) or ".")
+    os.close(handle)
+    try:
+        write_columnar_blocks(combined_path, blocks, columns, DATASET_DTYPE, positions)
+        features, labels, _, _ = open_columnar(combined_path)
+    finally:
+        os.remove(combined_path)
+    return (features, labels, FileWeights.concatenate(file_weights))
+
+
+def _split_region(args):
+    base_dir, all_files, region, seed, train_fraction, columns = args
+    try:
+        return (region, split_region(base_dir, all_files, region, seed, train_fraction,
+                                     columns=columns), None)
+    except Exception as err:
+        return (region, None, err)
+
+
+def create_instance_based_splitting(config, regions, logger, seed=0,
+                                    train_fraction=TRAIN_FRACTION, num_workers=1):
     with open(config["training_files"]) as f:
         all_training_files = f.readlines()
     with open(config["testing_files"]) as f:
         all_testing_files = f.readlines()
     all_files = all_training_files + all_testing_files
-    for region in regions:
-        features, labels, weights = get_all_data(config["base_dir"], all_files, region, logger)
-        shuffle_and_save(features, labels, weights, region)
+    # The shards only have the columns of the feature set of the config
+    columns = get_feature_columns(config)
+    tasks = [(config["base_dir"], all_files, region, seed, train_fraction, columns)
+             for region in regions]
+    with ProcessPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        for region, manifest, err in pool.map(_split_region, tasks):
+            if err is not None:
+                logger.log("Failed to split {}, Error, {}".format(region, err))
+                continue
+            logger.log("split, {}, training rows, {}, testing rows, {}".format(
+                region, sum(shard["rows"] for shard in manifest["training"]),
+                sum(shard["rows"] for shard in manifest["testing"])))
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Split the cached examples of each region into training and testing")
+    parser.add_argument("config")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--train-fraction", type=float, default=TRAIN_FRACTION)
+    parser.add_argument("--workers", type=int, default=1, help="regions split in parallel")
+    args = parser.parse_args()
     logger = Logger()
     logger.set_file_handle("splitting-by-instances.log")
-    with open(sys.argv[1]) as f:
+    with open(args.config) as f:
         config = json.load(f)
     config["base_dir"] = os.path.expanduser(config["base_dir"])
-    create_instance_based_splitting(config, regions, logger)
+    create_instance_based_splitting(
+        config, regions, logger, args.seed, args.train_fraction, args.workers)
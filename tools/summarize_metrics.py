@@ -0,0 +1,53 @@
+import json
+import sys
+from collections import defaultdict
+
+
+def load_records(filenames):
+    records = []
+    for filename in filenames:
+        with open(filename) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    record["file"] = filename
+                    records.append(record)
+    return records
+
+
+def summarize(records):
+    """Summarize the structured records of the training and testing runs per region.
+
+    Returns a dict from (file, region) to the load, binning and training seconds,
+    the mean seconds per tree, the peak RSS and the last evaluation results.
+    """
+    summary = defaultdict(lambda: defaultdict(float))
+    for record in records:
+        region = record.get("region") or record.get("model_region")
+        row = summary[(record["file"], region)]
+        row["peak_rss_mb"] = max(row["peak_rss_mb"], record["peak_rss"] / 2.0**20)
+        if record["event"] in ["load", "binning", "train"]:
+            row["{}_seconds".format(record["event"])] += record["seconds"]
+        elif record["event"] == "iteration":
+            row["trees"] = record["iteration"]
+            row["tree_seconds"] += record["seconds_per_tree"]
+            row["iterations"] += 1
+            row.update(record["metrics"])
+        elif record["event"] == "eval":
+            row["eval_seconds"] += record["seconds"]
+    for row in summary.values():
+        if "iterations" in row:
+            row["seconds_per_tree"] = row.pop("tree_seconds") / row.pop("iterations")
+    return summary
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m bathymetry.tools.summarize_metrics <jsonl_file> [<jsonl_file> ...]")
+        sys.exit(1)
+    summary = summarize(load_records(sys.argv[1:]))
+    # Slowest first
+    for (filename, region), row in sorted(
+            summary.items(), key=lambda item: -item[1]["train_seconds"]):
+        print("{}, {}, {}".format(filename, region, ", ".join(
+            "{}, {:.6g}".format(key, value) for key, value in sorted(row.items()))))
@@ -1,58 +1,126 @@
 import multiprocessing
+import os
 import lightgbm as lgb
+from time import time
 
+from .booster import has_checkpoint
 from .booster import train
+from .file_weights import get_row_weights
+from .load_data import get_binned_dataset_key
+from .load_data import get_binned_dataset_path
+from .load_data import get_feature_columns
 from .load_data import get_region_data
+from .load_data import get_region_files
 from .tools.split_by_instances import load_examples_from_pickle
 TRAIN_PREFIX = "train"
 VALID_PREFIX = "valid"
 LIMIT = None
+# Dataset parameters of LightGBM, they cannot change once a dataset is binned
+BINNING_PARAMS = [
+    "max_bin", "max_bin_by_feature", "min_data_in_bin", "bin_construct_sample_cnt",
+    "data_random_seed", "use_missing", "zero_as_missing", "is_enable_sparse", "enable_bundle",
+    "two_round", "linear_tree", "forcedbins_filename", "pre_partition",
+]
+
+
+def get_binning_params(config):
+    params = {key: config[key] for key in BINNING_PARAMS if key in config}
+    # Keep all features in the binned file, so that it can be reused with any `min_data_in_leaf`
+    params["feature_pre_filter"] = False
+    return params
+
+
+def get_lgb_dataset(config, files, regions, region_str, read_mode, prefix, logger,
+                    reference=None, reference_key=None, keep_raw_data=False):
+    """Load the binned LightGBM dataset of `regions` from disk, or build and save it.
+
+    A dataset built with a `reference` dataset shares its bin mappers. The text
+    files are always parsed again in the "tsv" read mode, and the dataset is
+    built from the examples if `keep_raw_data`, e.g. to resume from a checkpoint.
+
+    Returns
+    -------
+    dataset : tuple
+        ``(dataset, key)``, ``dataset`` is None if there are no examples.
+    """
+    base_dir = config["base_dir"]
+    params = get_binning_params(config)
+    columns = get_feature_columns(config)
+    region_files = get_region_files(files, regions)
+    key = get_binned_dataset_key(base_dir, region_files, prefix, params, reference_key, columns)
+    binned_path = get_binned_dataset_path(base_dir, prefix, region_str, key)
+    if read_mode != "tsv" and not keep_raw_data and os.path.exists(binned_path):
+        logger.log("loading the binned dataset, {}".format(binned_path))
+        start_time = time()
+        dataset = lgb.Dataset(binned_path, reference=reference, params=params).construct()
+        logger.record("binning", prefix=prefix, region=region_str, cached=True,
+                      rows=dataset.num_data(), seconds=time() - start_time)
+        return (dataset, key)
+
+    (features, labels, weights) = get_region_data(
+        base_dir, files, regions, read_mode, prefix, logger,
+        config.get("load_workers", 1), config.get("max_inflight_files"), columns)
+    if len(features) == 0:
+        return (None, key)
+    start_time = time()
+    # The weights are expanded for LightGBM only, which keeps a float32 copy of them
+    dataset = lgb.Dataset(
+        features, label=labels, weight=get_row_weights(weights), params=params,
+        reference=reference, free_raw_data=not keep_raw_data)
+    dataset.construct()
+    dataset.save_binary(binned_path)
+    logger.log("saved the binned dataset, {}".format(binned_path))
+    logger.record("binning", prefix=prefix, region=region_str, cached=False,
+                  rows=dataset.num_data(), seconds=time() - start_time)
+    return (dataset, key)
 
 
 def run_training_per_region(
-        config, regions, region_str, all_training_files, all_valid_files, is_read_text, logger):
+        config, regions, region_str, all_training_files, all_valid_files, read_mode, logger):
     logger.log("Now training {}".format(region_str))
 
     logger.log("start constructing datasets")
-    (t_features, t_labels, t_weights) = get_region_data(
-        config["base_dir"], all_training_files, regions, is_read_text, TRAIN_PREFIX, logger)
-    train_dataset = lgb.Dataset(
-        t_features, label=t_labels, weight=t_weights, params={'max_bin': config["max_bin"]})
-    (v_features, v_labels, v_weights) = get_region_data(
-        config["base_dir"], all_valid_files, regions, is_read_text, VALID_PREFIX, logger)
-    if len(v_features) == 0:
+    resume = has_checkpoint(config, region_str)
+    train_dataset, train_key = get_lgb_dataset(
+        config, all_training_files, regions, region_str, read_mode, TRAIN_PREFIX, logger,
+        keep_raw_data=resume)
+    if train_dataset is None:
+        logger.log("Failed to train, {}, {}".format(region_str, "no training data"))
+        return
+    # The validation data is binned with the bin mappers of the training data
+    valid_dataset, _ = get_lgb_dataset(
+        config, all_valid_files, regions, region_str, read_mode, VALID_PREFIX, logger,
+        train_dataset, train_key, resume)
+    if valid_dataset is None:
         logger.log("No validation data provided.")
-        valid_dataset = None
-    else:
-        valid_dataset = lgb.Dataset(
-            v_features, label=v_labels, weight=v_weights, params={'max_bin': config["max_bin"]})
 
     train(config, train_dataset, valid_dataset, region_str, logger)
 
 
-def run_training(config, regions, is_read_text, logger):
+def run_training(config, regions, read_mode, logger):
     with open(config["training_files"]) as f:
         all_training_files = f.readlines()
     with open(config["validation_files"]) as f:
         all_valid_files = f.readlines()
     for region in regions:
         run_training_per_region(
-            config, [region], region, all_training_files, all_valid_files, is_read_text, logger)
+            config, [region], region, all_training_files, all_valid_files, read_mode, logger)
 
 
-def run_training_all(config, regions, is_read_text, logger):
+def run_training_all(config, regions, read_mode, logger):
     with open(config["training_files"]) as f:
         all_training_files = f.readlines()
     with open(config["validation_files"]) as f:
         all_valid_files = f.readlines()
     run_training_per_region(
-        config, regions, "all", all_training_files, all_valid_files, is_read_text, logger)
+        config, regions, "all", all_training_files, all_valid_files, read_mode, logger)
 
 
 # Specify a data file
 def run_training_specific_file(filenames, region_name, config, logger):
-    features, labels, weights = load_examples_from_pickle(filenames)
+    features, labels, weights = load_examples_from_pickle(filenames, get_feature_columns(config))
     train_dataset = lgb.Dataset(
-        features, label=labels, weight=weights, params={'max_bin': config["max_bin"]})
+        features, label=labels, weight=get_row_weights(weights),
+        params={'max_bin': config["max_bin"]})
 
     train(config, train_dataset, None, region_name, logger)
@@ -0,0 +1,229 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Bits of `decision_type` in the LightGBM text model
+CATEGORICAL_MASK = 1
+DEFAULT_LEFT_MASK = 2
+MISSING_ZERO = 1
+MISSING_NAN = 2
+ZERO_THRESHOLD = 1e-35
+# Largest difference of the scores allowed by `check_parity`
+PARITY_TOLERANCE = 1e-9
+# Number of (row, tree) pairs traversed together, bounds the memory of a batch
+TRAVERSAL_CELLS = 4 * 1024 * 1024
+
+
+def _parse_values(value, dtype):
+    if value == "":
+        return np.empty(0, dtype=dtype)
+    return np.array(value.split(" "), dtype=np.float64).astype(dtype)
+
+
+def _parse_blocks(text):
+    """Split the text model into its header and the key-value pairs of each tree."""
+    text = text.split("end of trees")[0]
+    header = {}
+    trees = []
+    current = header
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if "=" not in line:
+            # Flags of the header, such as `average_output`
+            current[line] = ""
+            continue
+        key, value = line.split("=", 1)
+        if key == "Tree":
+            current = {}
+            trees.append(current)
+            continue
+        current[key] = value
+    return (header, trees)
+
+
+class TreeEnsemble:
+    """A LightGBM model compiled into flat NumPy arrays, for scoring without LightGBM.
+
+    All nodes of all trees, internal nodes and leaves alike, are stored in one
+    set of arrays. The children of node `i` are `children[2 * i]` (right) and
+    `children[2 * i + 1]` (left), so that a node moves to `children[2 * i + go_left]`.
+    Only numerical splits are supported.
+    """
+    def __init__(self, roots, feature, threshold, default_left, missing_type, left, right,
+                 value, is_leaf, sigmoid=None, num_features=None):
+        self.roots = roots
+        self.feature = feature
+        self.threshold = threshold
+        self.value = value
+        self.is_leaf = is_leaf
+        self.sigmoid = sigmoid
+        self.num_features = num_features
+        self.children = np.empty(2 * len(feature), dtype=np.int64)
+        self.children[0::2] = right
+        self.children[1::2] = left
+        # LightGBM treats NaN as zero unless NaN is the missing value of the split,
+        # so the direction of NaN is fixed per node
+        self.nan_left = np.where(
+            (missing_type == MISSING_NAN) | (missing_type == MISSING_ZERO),
+            default_left, 0.0 <= threshold)
+        self.zero_missing = missing_type == MISSING_ZERO
+        self.default_left = default_left
+
+    @classmethod
+    def from_file(cls, txt_model_path):
+        with open(txt_model_path) as f:
+            return cls.from_string(f.read())
+
+    @classmethod
+    def from_string(cls, text):
+        header, trees = _parse_blocks(text)
+        if int(header.get("num_tree_per_iteration", 1)) != 1:
+            raise ValueError("only models with one tree per iteration are supported")
+        if "average_output" in header:
+            # Random forests (boosting=rf) average the trees instead of summing them
+            raise ValueError("models with averaged outputs are not supported")
+        sigmoid = None
+        objective = header.get("objective", "").split(" ")
+        if objective[0] == "binary":
+            sigmoid = 1.0
+            for arg in objective[1:]:
+                if arg.startswith("sigmoid:"):
+                    sigmoid = float(arg.split(":", 1)[1])
+        elif objective[0] not in ["regression", "regression_l2", "regression_l1", "huber"]:
+            raise ValueError("objective {} is not supported".format(objective[0]))
+
+        roots = []
+        arrays = {
+            "feature": [], "threshold": [], "decision_type": [], "left": [], "right": [],
+            "value": [], "is_leaf": [],
+        }
+        offset = 0
+        for tree in trees:
+            if int(tree.get("is_linear", 0)):
+                raise ValueError("linear trees are not supported")
+            if int(tree.get("num_cat", 0)):
+                raise ValueError("categorical splits are not supported")
+            num_leaves = int(tree["num_leaves"])
+            num_internal = num_leaves - 1
+            leaf_value = _parse_values(tree["leaf_value"], np.float64)
+            # Internal nodes take [offset, offset + num_internal), leaves follow
+            leaf_ids = offset + num_internal + np.arange(num_leaves, dtype=np.int64)
+            if num_internal > 0:
+                # A negative child `c` is the leaf `~c`
+                left = _parse_values(tree["left_child"], np.int64)
+                right = _parse_values(tree["right_child"], np.int64)
+                arrays["feature"].append(_parse_values(tree["split_feature"], np.int64))
+                arrays["threshold"].append(_parse_values(tree["threshold"], np.float64))
+                arrays["decision_type"].append(_parse_values(tree["decision_type"], np.int64))
+                arrays["left"].append(np.where(left >= 0, offset + left, leaf_ids[0] + ~left))
+                arrays["right"].append(np.where(right >= 0, offset + right, leaf_ids[0] + ~right))
+                arrays["value"].append(np.zeros(num_internal))
+                arrays["is_leaf"].append(np.zeros(num_internal, dtype=bool))
+            arrays["feature"].append(np.zeros(num_leaves, dtype=np.int64))
+            arrays["threshold"].append(np.zeros(num_leaves))
+            arrays["decision_type"].append(np.zeros(num_leaves, dtype=np.int64))
+            arrays["left"].append(leaf_ids)
+            arrays["right"].append(leaf_ids)
+            arrays["value"].append(leaf_value)
+            arrays["is_leaf"].append(np.ones(num_leaves, dtype=bool))
+            roots.append(offset)
+            offset += num_internal + num_leaves
+        arrays = {key: np.concatenate(values) if values else np.empty(0)
+                  for key, values in arrays.items()}
+        decision_type = arrays["decision_type"].astype(np.int64)
+        if np.any(decision_type & CATEGORICAL_MASK):
+            raise ValueError("categorical splits are not supported")
+        return cls(
+            roots=np.array(roots, dtype=np.int64),
+            feature=arrays["feature"].astype(np.int64),
+            threshold=arrays["threshold"].astype(np.float64),
+            default_left=(decision_type & DEFAULT_LEFT_MASK) > 0,
+            missing_type=((decision_type >> 2) & 3).astype(np.int8),
+            left=arrays["left"].astype(np.int64),
+            right=arrays["right"].astype(np.int64),
+            value=arrays["value"].astype(np.float64),
+            is_leaf=arrays["is_leaf"].astype(bool),
+            sigmoid=sigmoid,
+            num_features=int(header.get("max_feature_idx", -1)) + 1,
+        )
+
+    def num_trees(self):
+        return len(self.roots)
+
+    def _predict_raw_batch(self, features):
+        num_rows, num_cols = features.shape
+        num_trees = len(self.roots)
+        flat = features.ravel()
+        nodes = np.tile(self.roots, num_rows)
+        active = np.flatnonzero(~self.is_leaf[nodes])
+        current = nodes[active]
+        row_offsets = (active // num_trees) * num_cols
+        has_zero_missing = bool(np.any(self.zero_missing))
+        # Move all (row, tree) pairs that have not reached a leaf down by one level
+        while active.size > 0:
+            values = flat[row_offsets + self.feature[current]]
+            go_left = values <= self.threshold[current]
+            is_nan = np.isnan(values)
+            if np.any(is_nan):
+                go_left[is_nan] = self.nan_left[current[is_nan]]
+            if has_zero_missing:
+                is_zero = self.zero_missing[current] & (np.abs(values) <= ZERO_THRESHOLD)
+                go_left[is_zero] = self.default_left[current[is_zero]]
+            current = self.children[2 * current + go_left]
+            in_leaf = self.is_leaf[current]
+            if np.any(in_leaf):
+                nodes[active[in_leaf]] = current[in_leaf]
+                keep = ~in_leaf
+                active, current, row_offsets = active[keep], current[keep], row_offsets[keep]
+        return self.value[nodes].reshape(num_rows, num_trees).sum(axis=1)
+
+    def predict(self, data, raw_score=False, num_threads=0, batch_size=None):
+        """Predict the scores of `data`, same as `lightgbm.Booster.predict`.
+
+        Batches of `batch_size` rows (by default sized by `TRAVERSAL_CELLS`) are
+        scored in `num_threads` threads.
+        """
+        # Row-major, so that a batch is a contiguous block of the flat feature array
+        features = np.ascontiguousarray(data, dtype=np.float64)
+        if features.ndim == 1:
+            features = features.reshape(1, -1)
+        if self.num_features and features.shape[1] != self.num_features:
+            raise ValueError("the model expects {} features, got {}".format(
+                self.num_features, features.shape[1]))
+        if batch_size is None:
+            batch_size = max(1, TRAVERSAL_CELLS // max(1, self.num_trees()))
+        raw = np.zeros(features.shape[0])
+        batches = [(st, min(features.shape[0], st + batch_size))
+                   for st in range(0, features.shape[0], batch_size)]
+
+        def predict_batch(batch):
+            st, ed = batch
+            raw[st:ed] = self._predict_raw_batch(features[st:ed])
+
+        if self.num_trees() > 0:
+            if num_threads > 1 and len(batches) > 1:
+                with ThreadPoolExecutor(max_workers=num_threads) as pool:
+                    list(pool.map(predict_batch, batches))
+            else:
+                for batch in batches:
+                    predict_batch(batch)
+        if raw_score or self.sigmoid is None:
+            return raw
+        return 1.0 / (1.0 + np.exp(-self.sigmoid * raw))
+
+
+def check_parity(booster, ensemble, features, tolerance=PARITY_TOLERANCE):
+    """Check that `ensemble` scores `features` as the LightGBM `booster` does.
+
+    Returns the largest absolute difference of the scores, and raises
+    ValueError if it exceeds `tolerance`.
+    """
+    expected = booster.predict(features)
+    scores = ensemble.predict(features)
+    max_diff = float(np.max(np.abs(expected - scores))) if len(scores) else 0.0
+    if not max_diff <= tolerance:
+        raise ValueError("the scores differ from LightGBM by {:.3g}, more than {:.3g}".format(
+            max_diff, tolerance))
+    return max_diff